@@ -0,0 +1,212 @@
+import hashlib
+import warnings
+from datetime import datetime, timedelta
+from itertools import repeat
+from operator import is_not, methodcaller
+
+# Survey analytics behind the dashboard endpoints. POST /surveys/ adds each
+# survey to the tallies with survey_tally_updates; a rebuild loads all the
+# surveys into a SurveyFrame and computes the same tallies with vectorized
+# group-bys. NumPy is imported on first use, like the Firebase SDK in main.
+
+# Survey fields the reports group by
+SURVEY_COLUMNS = ["candidateId", "electionId", "precintList", "age", "gender"]
+# Voter fields the reports group by (the voter's location)
+VOTER_COLUMNS = ["Province", "City"]
+# One SurveyGraphTallies document per distinct combination of these
+GRAPH_COLUMNS = ["candidateId", "electionId", "Province", "City", "precintList"]
+
+
+def tally_key(value):
+    # Firestore map keys cannot be empty
+    return str(value) if value not in (None, "") else "(blank)"
+
+
+def tally_values(buckets):
+    # The values counted in an age or gender bucket map, one per survey
+    return [("" if value == "(blank)" else value) for value, count in sorted(buckets.items()) for _ in range(count)]
+
+
+def survey_week(created_at):
+    # Monday of the week a survey was created, as YYYY-MM-DD
+    if isinstance(created_at, str):
+        try:
+            created_at = datetime.fromisoformat(created_at.replace(' UTC', '').rstrip('Z'))
+        except ValueError:
+            return None
+    if not isinstance(created_at, datetime):
+        return None
+    return (created_at.date() - timedelta(days=created_at.weekday())).isoformat()
+
+
+def survey_weeks(values):
+    # survey_week for a whole column. Plain ISO strings (what POST /surveys/
+    # stores) are parsed by NumPy in one go; anything else goes row by row.
+    import numpy as np
+
+    if all(type(value) is str and len(value) >= 10 for value in values):
+        try:
+            with warnings.catch_warnings():
+                # Time zones are deprecated in datetime64 strings
+                warnings.simplefilter("error")
+                days = np.array(values, dtype="datetime64[us]").astype("datetime64[D]")
+            # 1970-01-01 was a Thursday
+            mondays = days - (days.astype(np.int64) + 3) % 7
+            return mondays.astype(str).tolist()
+        except (ValueError, TypeError, Warning):
+            pass
+    return [survey_week(value) for value in values]
+
+
+def graph_tally_id(candidate_id, election_id, province, city, precinct):
+    key = "\x1f".join(str(part) for part in (candidate_id, election_id, province, city, precinct))
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def survey_tally_updates(survey, voter):
+    # What one survey adds to the tallies: (summary update, graph document ID,
+    # graph update). Counts are 1 and get summed; other values overwrite.
+    # Like the scans they replace, surveys of unknown voters stay out of the graphs.
+    candidate = tally_key(survey.get('candidateId'))
+    summary = {"candidates": {candidate: 1}}
+    week = survey_week(survey.get('created_at'))
+    if week:
+        summary["weeks"] = {week: {candidate: 1}}
+        summary["week_precincts"] = {week: {candidate: survey.get('precintList')}}
+
+    if voter is None:
+        return summary, None, None
+    key = (survey.get('candidateId'), survey.get('electionId'), voter.get('Province'), voter.get('City'), survey.get('precintList'))
+    graph = {
+        "candidateId": key[0],
+        "electionId": key[1],
+        "Province": key[2],
+        "City": key[3],
+        "precintList": key[4],
+        "votes": 1,
+        "ages": {tally_key(survey.get('age')): 1},
+        "genders": {tally_key(survey.get('gender')): 1},
+    }
+    return summary, graph_tally_id(*key), graph
+
+
+def add_tally(total, update):
+    for key, value in update.items():
+        if isinstance(value, dict):
+            add_tally(total.setdefault(key, {}), value)
+        elif isinstance(value, int):
+            total[key] = total.get(key, 0) + value
+        else:
+            total[key] = value
+    return total
+
+
+class SurveyFrame:
+    # The surveys as columns, in the order they were added. Every column is
+    # stored as its distinct values plus one integer code per survey, so a
+    # group-by is a few array operations however many surveys there are.
+    def __init__(self, surveys, voters):
+        import numpy as np
+
+        self.size = len(surveys)
+        self.values = {}
+        self.codes = {}
+        # Read in the order given (much faster than after sorting the dicts)
+        # and then put in the order they were added, so "last" means latest
+        fields = {field: list(map(methodcaller("get", field), surveys)) for field in SURVEY_COLUMNS + ["userDocumentId", "created_at"]}
+        self.order = np.argsort(np.array(list(map(str, fields["created_at"]))), kind="stable")
+        for column in SURVEY_COLUMNS:
+            self.add_column(column, fields[column])
+
+        # voters is {(precinct, voter document ID): voter data}, see get_survey_voters
+        located = list(map(voters.get, zip(fields["precintList"], fields["userDocumentId"])))
+        self.has_voter = np.fromiter(map(is_not, located, repeat(None)), dtype=bool, count=self.size)[self.order]
+        located = [voter or {} for voter in located]
+        for column in VOTER_COLUMNS:
+            self.add_column(column, list(map(methodcaller("get", column), located)))
+
+        weeks = survey_weeks(fields["created_at"])
+        self.add_column("week", weeks)
+        self.has_week = np.fromiter(map(bool, weeks), dtype=bool, count=self.size)[self.order]
+
+    def add_column(self, column, values):
+        import numpy as np
+
+        # Distinct values in order of first appearance, then their codes
+        index = dict.fromkeys(values)
+        for code, value in enumerate(index):
+            index[value] = code
+        self.codes[column] = np.fromiter(map(index.__getitem__, values), dtype=np.int64, count=len(values))[self.order]
+        self.values[column] = list(index)
+
+    def group_by(self, columns, rows=None, within=None):
+        # Groups the surveys, or only those in the boolean mask rows, by
+        # columns. within is the result of an earlier group_by to split those
+        # groups further. Returns (group of every survey, -1 where not
+        # selected; surveys per group; index of the latest survey per group).
+        import numpy as np
+
+        selected = np.arange(self.size) if rows is None else np.flatnonzero(rows)
+        # Combine the codes column by column, renumbering after each one so
+        # the combined code stays small however many columns there are
+        key = np.zeros(len(selected), dtype=np.int64) if within is None else within[selected]
+        for column in columns:
+            _, key = np.unique(key * len(self.values[column]) + self.codes[column][selected], return_inverse=True)
+            key = key.reshape(-1)
+        groups = np.full(self.size, -1, dtype=np.int64)
+        groups[selected] = key
+        # Surveys are in the order they were added: the latest of a group is
+        # its first one counting from the end
+        _, from_end = np.unique(key[::-1], return_index=True)
+        return groups, np.bincount(key), selected[len(selected) - 1 - from_end]
+
+    def column_values(self, column, rows=None):
+        # The values of column for the surveys at rows, or for all of them
+        codes = self.codes[column] if rows is None else self.codes[column][rows]
+        return list(map(self.values[column].__getitem__, codes.tolist()))
+
+    def summary_tallies(self):
+        # SurveyTallies/summary: votes per candidate and per week, and the
+        # precinct of the latest survey of every candidate and week
+        import numpy as np
+
+        summary = {"candidates": {}, "weeks": {}, "week_precincts": {}}
+        _, counts, last = self.group_by(["candidateId"])
+        for candidate, count in zip(self.column_values("candidateId", last), counts.tolist()):
+            add_tally(summary["candidates"], {tally_key(candidate): count})
+
+        _, counts, last = self.group_by(["week", "candidateId"], self.has_week)
+        # Latest group last, so its precinct is the one that stays
+        order = np.argsort(last)
+        last, counts = last[order], counts[order]
+        weeks, candidates, precincts = (self.column_values(column, last) for column in ("week", "candidateId", "precintList"))
+        for week, candidate, precinct, count in zip(weeks, candidates, precincts, counts.tolist()):
+            add_tally(summary["weeks"], {week: {tally_key(candidate): count}})
+            add_tally(summary["week_precincts"], {week: {tally_key(candidate): precinct}})
+        return summary
+
+    def graph_tallies(self):
+        # SurveyGraphTallies: {document ID: votes, ages and genders} per
+        # GRAPH_COLUMNS, for the surveys whose voter was found
+        import numpy as np
+
+        graphs = {}
+        groups, counts, last = self.group_by(GRAPH_COLUMNS, self.has_voter)
+        order = np.argsort(last)
+        graph_ids = [None] * len(counts)
+        keys = zip(*(self.column_values(column, last[order]) for column in GRAPH_COLUMNS))
+        for group, count, key in zip(order.tolist(), counts[order].tolist(), keys):
+            graph_id = graph_ids[group] = graph_tally_id(*key)
+            update = {**dict(zip(GRAPH_COLUMNS, key)), "votes": count}
+            if graph_id in graphs:
+                add_tally(graphs[graph_id], update)
+            else:
+                graphs[graph_id] = update
+
+        for field, column in (("ages", "age"), ("genders", "gender")):
+            _, counts, last = self.group_by([column], self.has_voter, within=groups)
+            for group, value, count in zip(groups[last].tolist(), self.column_values(column, last), counts.tolist()):
+                buckets = graphs[graph_ids[group]].setdefault(field, {})
+                value = tally_key(value)
+                buckets[value] = buckets.get(value, 0) + count
+        return graphs
@@ -0,0 +1,116 @@
+# Survey analytics benchmark: the per-survey tally fold against SurveyFrame.
+#
+#   python benchmarks/analytics_bench.py --sizes 100000,500000 --output results.json
+#
+# For every size a synthetic Survey collection (and the voters it refers to)
+# is generated in memory and the dashboard tallies are computed twice: one
+# survey at a time with survey_tally_updates, as POST /surveys/ does, and with
+# a SurveyFrame, as a rebuild does. Both must give the same tallies. Loading
+# the frame (building the columns) and the group-bys are timed separately.
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Puts the repository on sys.path for the app modules below
+from bench_common import add_output_argument, new_report, write_report
+
+from analytics import SurveyFrame, add_tally, survey_tally_updates
+
+
+def synthetic_surveys(count, candidates=10, elections=2, precincts=500, seed=0):
+    # Returns (surveys, voters) shaped like get_survey_voters' result. About
+    # one survey in twenty refers to a voter that no longer exists.
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    surveys = []
+    voters = {}
+    for number in range(count):
+        precinct = f"{rng.randrange(precincts):04d}A"
+        voter_id = f"voter{number}"
+        surveys.append({
+            "candidateId": f"candidate{rng.randrange(candidates)}",
+            "electionId": f"election{rng.randrange(elections)}",
+            "surveyorId": f"surveyor{rng.randrange(200)}",
+            "precintList": precinct,
+            "userDocumentId": voter_id,
+            "age": str(rng.randint(18, 90)),
+            "gender": rng.choice(["Male", "Female", ""]),
+            "created_at": (start + timedelta(seconds=rng.randrange(180 * 86400))).isoformat(),
+        })
+        if rng.random() > 0.05:
+            index = int(precinct[:4])
+            voters[(precinct, voter_id)] = {"Province": f"PROVINCE {index // 500 + 1}", "City": f"MUNICIPALITY {index // 50 + 1}"}
+    return surveys, voters
+
+
+def fold_tallies(surveys, voters):
+    summary = {"candidates": {}, "weeks": {}, "week_precincts": {}}
+    graphs = {}
+    for survey in sorted(surveys, key=lambda survey: str(survey.get('created_at'))):
+        voter = voters.get((survey.get('precintList'), survey.get('userDocumentId')))
+        summary_update, graph_id, graph = survey_tally_updates(survey, voter)
+        add_tally(summary, summary_update)
+        if graph is not None:
+            add_tally(graphs.setdefault(graph_id, {}), graph)
+    return summary, graphs
+
+
+def measure(count, repeat, precincts):
+    surveys, voters = synthetic_surveys(count, precincts=precincts)
+    # Warm up (NumPy import) before timing
+    SurveyFrame(surveys[:100], voters).graph_tallies()
+
+    fold_seconds, load_seconds, group_seconds = [], [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        expected = fold_tallies(surveys, voters)
+        fold_seconds.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        frame = SurveyFrame(surveys, voters)
+        loaded = time.perf_counter()
+        result = frame.summary_tallies(), frame.graph_tallies()
+        load_seconds.append(loaded - started)
+        group_seconds.append(time.perf_counter() - loaded)
+
+    if result != expected:
+        sys.exit(f"{count} surveys: SurveyFrame tallies differ from the per-survey fold")
+    frame_seconds = min(load + group for load, group in zip(load_seconds, group_seconds))
+    return {
+        "surveys": count,
+        "graph_documents": len(result[1]),
+        "fold_seconds": round(min(fold_seconds), 4),
+        "frame_load_seconds": round(min(load_seconds), 4),
+        "frame_group_by_seconds": round(min(group_seconds), 4),
+        "frame_seconds": round(frame_seconds, 4),
+        "speedup": round(min(fold_seconds) / frame_seconds, 2),
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the survey tally computation")
+    arg_parser.add_argument("--sizes", default="100000,250000", help="comma separated survey counts")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    arg_parser.add_argument("--precincts", type=int, default=500, help="precincts the surveys are spread over")
+    add_output_argument(arg_parser)
+    args = arg_parser.parse_args()
+
+    import numpy
+
+    report = new_report(
+        numpy=numpy.__version__,
+        cases=[],
+    )
+    for size in args.sizes.split(","):
+        case = measure(int(size), args.repeat, args.precincts)
+        report["cases"].append(case)
+        print(f"{case['surveys']} surveys: fold {case['fold_seconds']:.3f}s, frame {case['frame_seconds']:.3f}s "
+              f"(load {case['frame_load_seconds']:.3f}s, group-by {case['frame_group_by_seconds']:.3f}s), {case['speedup']}x")
+
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Session and password cost benchmark.
+#
+#   python benchmarks/auth_bench.py --iterations 100000,260000,600000
+#
+# Times what /signin spends on the password for each PBKDF2 iteration count
+# (PASSWORD_HASH_ITERATIONS), and what verifying a session token costs an
+# endpoint, to pick the cost against login latency.
+import argparse
+import time
+
+# Puts the repository on sys.path for the app modules below
+from bench_common import add_output_argument, new_report, write_report
+
+from sessions import SessionSigner, check_password, hash_password
+
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark password hashing and session token checks")
+    arg_parser.add_argument("--iterations", default="100000,260000,600000", help="comma separated PBKDF2 iteration counts")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    add_output_argument(arg_parser)
+    args = arg_parser.parse_args()
+
+    report = new_report(
+        passwords=[],
+    )
+    for iterations in map(int, args.iterations.split(",")):
+        stored = hash_password("correct horse battery staple", iterations)
+        seconds = best_time(lambda: check_password(stored, "correct horse battery staple"), args.repeat)
+        report["passwords"].append({"iterations": iterations, "check_seconds": round(seconds, 4)})
+        print(f"{iterations} iterations: {seconds * 1000:.1f} ms per password check")
+
+    signer = SessionSigner(["benchmark"], 900, 86400)
+    token = signer.issue("access", "user", username="Surveyor", selectedMode="surveyor")
+    count = 20000
+    started = time.perf_counter()
+    for _ in range(count):
+        signer.verify(token, "access")
+    verify_seconds = (time.perf_counter() - started) / count
+    report["token_verify_microseconds"] = round(verify_seconds * 1e6, 2)
+    print(f"Session token check: {verify_seconds * 1e6:.1f} µs")
+
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Shared by the benchmark scripts. Importing it puts the repository on
+# sys.path, so the app modules import after it; new_report and write_report
+# make the JSON report every script prints or writes to --output.
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def add_output_argument(arg_parser):
+    arg_parser.add_argument("--output", help="write the results as JSON to this file")
+
+
+def new_report(**fields):
+    # When and where the benchmark ran, then fields
+    return {
+        "generated_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        **fields,
+    }
+
+
+def write_report(report, output=None):
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
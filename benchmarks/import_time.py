@@ -0,0 +1,103 @@
+# Cold-start import profile for main.py.
+#
+#   python benchmarks/import_time.py [--runs 5] [--budget-ms 800] [--output results.json]
+#
+# Imports main in fresh interpreters with -X importtime and prints the
+# slowest imports. Exits non-zero when a module that should only load on
+# first use (the Firebase SDK, gRPC, pdfplumber, ...) is imported at startup,
+# or when the median import time is over --budget-ms. Run it in CI to catch
+# cold-start regressions.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from bench_common import REPO_DIR, add_output_argument, new_report, write_report
+
+# Only needed once a request touches Firestore or uploads a PDF
+LAZY_MODULES = [
+    "firebase_admin",
+    "google.cloud.firestore",
+    "google.api_core",
+    "grpc",
+    "pdfplumber",
+    "pdfminer",
+    "numpy",
+    "brotli",
+    "werkzeug",
+]
+
+
+def profile_import():
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    env.pop("FIRESTORE_EMULATOR_HOST", None)
+    # main creates its upload folders in the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            cwd=directory, env=env, capture_output=True, text=True,
+        )
+    if result.returncode != 0:
+        sys.exit(f"import main failed:\n{result.stderr}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        imports.append((name.strip(), int(cumulative) / 1000))
+    return imports
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Profile the import time of main.py")
+    arg_parser.add_argument("--runs", type=int, default=5)
+    arg_parser.add_argument("--budget-ms", type=float, help="fail when the median import of main takes longer")
+    arg_parser.add_argument("--top", type=int, default=10)
+    add_output_argument(arg_parser)
+    args = arg_parser.parse_args()
+
+    totals = []
+    for _ in range(args.runs):
+        imports = profile_import()
+        totals.append(dict(imports)["main"])
+
+    slowest = sorted(imports, key=lambda item: item[1], reverse=True)[:args.top]
+    print("slowest imports (last run, cumulative ms):")
+    for name, milliseconds in slowest:
+        print(f"  {milliseconds:8.1f}  {name}")
+
+    median = statistics.median(totals)
+    print(f"import main: median {median:.1f} ms over {args.runs} runs")
+
+    failed = False
+    eager_modules = []
+    loaded = {name for name, _ in imports}
+    for module in LAZY_MODULES:
+        eager = sorted(name for name in loaded if name == module or name.startswith(module + "."))
+        if eager:
+            print(f"FAIL: {module} is imported at startup ({', '.join(eager[:3])})")
+            eager_modules.append(module)
+            failed = True
+
+    if args.budget_ms is not None and median > args.budget_ms:
+        print(f"FAIL: import main takes {median:.1f} ms, budget is {args.budget_ms:.1f} ms")
+        failed = True
+
+    write_report(new_report(
+        runs=args.runs,
+        median_ms=round(median, 1),
+        budget_ms=args.budget_ms,
+        slowest=[{"module": name, "cumulative_ms": round(milliseconds, 1)} for name, milliseconds in slowest],
+        eager_modules=eager_modules,
+        failed=failed,
+    ), args.output)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Ingestion benchmark: parser and Firestore loader throughput.
+#
+#   python benchmarks/ingestion_bench.py --sizes 50x5x50,200x20x50 --output results.json
+#
+# Each size is PAGESxPRECINCTSxVOTERS_PER_PAGE. For every size a synthetic
+# voter-list PDF is generated and extract_voter_information_from_pdf is timed
+# in a fresh process, reporting pages/sec, voters/sec and peak RSS.
+#
+# With --firestore the write phase of /addusers (IngestionJob.run, fed from
+# the warmed parse cache) is timed as well. That needs a running emulator:
+#
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmarks/ingestion_bench.py --firestore
+#
+# The emulator database is wiped before every write run.
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+from bench_common import REPO_DIR, add_output_argument, new_report, write_report
+from synthetic_pdf import generate
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def measure_parse(pdf_path, workers, mode, api):
+    import voter_parser
+
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    if api == "stream":
+        voters = sum(1 for _, voter in voter_parser.iter_voter_information_from_pdf(pdf_path, workers, mode=mode) if voter is not None)
+    else:
+        results = voter_parser.extract_voter_information_from_pdf(pdf_path, workers, mode=mode)
+        voters = sum(data["total_voters"] for data in results.values())
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "voters": voters, "rss_before_mb": rss_before, "peak_rss_mb": peak_rss_mb()}
+
+
+def clear_emulator(project):
+    host = os.environ["FIRESTORE_EMULATOR_HOST"]
+    url = f"http://{host}/emulator/v1/projects/{project}/databases/(default)/documents"
+    urllib.request.urlopen(urllib.request.Request(url, method="DELETE")).close()
+
+
+def measure_firestore(pdf_path):
+    os.chdir(REPO_DIR)
+    import main
+    import voter_parser
+
+    clear_emulator(main.db.project)
+
+    # Parse once so the timed run only replays the cache and writes
+    sha256 = voter_parser.file_sha256(pdf_path)
+    for _ in voter_parser.iter_voter_information_cached(pdf_path, sha256):
+        pass
+
+    job = main.IngestionJob(uuid.uuid4().hex, os.path.basename(pdf_path), pdf_path, sha256)
+    started = time.perf_counter()
+    job.run()
+    seconds = time.perf_counter() - started
+    return {
+        "seconds": seconds,
+        "status": job.status,
+        "errors": job.errors,
+        "voters": job.voters_written,
+        "precincts": job.precincts_done,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_isolated(function, *args):
+    # A fresh interpreter per measurement keeps peak RSS and warm caches apart
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def parse_size(size):
+    pages, precincts, voters_per_page = (int(part) for part in size.lower().split("x"))
+    return pages, precincts, voters_per_page
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark voter-list parsing and Firestore ingestion")
+    arg_parser.add_argument("--sizes", default="20x2x50,100x10x50", help="comma separated PAGESxPRECINCTSxVOTERS_PER_PAGE")
+    arg_parser.add_argument("--workers", type=int, default=1, help="parser worker processes (0 = one per CPU)")
+    arg_parser.add_argument("--mode", default="fast", choices=["fast", "reference"])
+    arg_parser.add_argument("--api", default="extract", choices=["extract", "stream"], help="materialize the result or only stream it")
+    arg_parser.add_argument("--firestore", action="store_true", help="also time the write phase against the Firestore emulator")
+    add_output_argument(arg_parser)
+    args = arg_parser.parse_args()
+
+    if args.firestore and not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        arg_parser.error("--firestore needs FIRESTORE_EMULATOR_HOST")
+
+    workers = args.workers or os.cpu_count()
+    report = new_report(
+        cpus=os.cpu_count(),
+        workers=workers,
+        mode=args.mode,
+        api=args.api,
+        cases=[],
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes.split(","):
+            pages, precincts, voters_per_page = parse_size(size)
+            pdf_path = generate(os.path.join(directory, f"voters_{size}.pdf"), pages, precincts, voters_per_page)
+
+            parse = run_isolated(measure_parse, pdf_path, workers, args.mode, args.api)
+            parse["pages_per_sec"] = round(pages / parse["seconds"], 2)
+            parse["voters_per_sec"] = round(parse["voters"] / parse["seconds"], 1)
+            case = {
+                "pages": pages,
+                "precincts": precincts,
+                "voters_per_page": voters_per_page,
+                "pdf_bytes": os.path.getsize(pdf_path),
+                "parse": parse,
+            }
+            print(f"{size}: parse {parse['seconds']:.2f}s, {parse['pages_per_sec']} pages/sec, {parse['voters_per_sec']} voters/sec, peak RSS {parse['peak_rss_mb']} MB")
+
+            if args.firestore:
+                write = run_isolated(measure_firestore, pdf_path)
+                write["voters_per_sec"] = round(write["voters"] / write["seconds"], 1)
+                case["firestore"] = write
+                print(f"{size}: write {write['seconds']:.2f}s, {write['voters_per_sec']} voters/sec ({write['status']})")
+
+            report["cases"].append(case)
+
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# Line classifier microbenchmark and golden-output check.
+#
+#   python benchmarks/parser_bench.py [voter_list.pdf | lines.txt] [--repeat N] [--output results.json]
+#
+# Feeds the same lines through the "reference" regex chain and the "fast"
+# single-pass classifier, fails if the two produce different events, and
+# reports lines/sec for each mode. Without a file a synthetic sample is used.
+import argparse
+import sys
+import time
+
+# Puts the repository on sys.path for the app modules below
+from bench_common import add_output_argument, new_report, write_report
+
+from synthetic_pdf import voter_list_pages
+from voter_parser import LINE_CLASSIFIERS, VoterListParser
+
+# Lines the synthetic sample does not produce, always part of the golden
+# check: headers with an empty value
+EDGE_LINES = [
+    "CITY / MUNICIPALITY : ",
+    "PROVINCE : ",
+    "BARANGAY : ",
+    "PROVINCE : X CITY / MUNICIPALITY : ",
+]
+
+
+def sample_lines(count, seed=0):
+    # Enough synthetic pages for the requested number of lines
+    lines = []
+    for page in voter_list_pages(count // 50 + 1, count // 500 + 1, 50, seed=seed):
+        lines.extend(page)
+    return lines[:count]
+
+
+def load_lines(path):
+    if path.lower().endswith(".pdf"):
+        import pdfplumber
+        lines = []
+        with pdfplumber.open(path) as pdf:
+            for page in pdf.pages:
+                lines.extend(page.extract_text().split("\n"))
+        return lines
+    with open(path) as f:
+        return f.read().split("\n")
+
+
+def run(lines, mode):
+    parser = VoterListParser(mode)
+    return [parser.feed_line(line) for line in lines]
+
+
+def time_mode(lines, mode, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run(lines, mode)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the voter-list line classifiers and check they agree")
+    arg_parser.add_argument("path", nargs="?", help="voter-list PDF or text file with one line per line")
+    arg_parser.add_argument("--lines", type=int, default=200000, help="synthetic sample size")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    add_output_argument(arg_parser)
+    args = arg_parser.parse_args()
+
+    lines = load_lines(args.path) if args.path else sample_lines(args.lines)
+
+    # Golden check: both modes must classify every line the same and
+    # produce exactly the same events
+    checked = EDGE_LINES + lines
+    for line in EDGE_LINES:
+        expected, actual = LINE_CLASSIFIERS["reference"](line), LINE_CLASSIFIERS["fast"](line)
+        if expected != actual:
+            print(f"Mismatch on {line!r}")
+            print(f"  reference: {expected}")
+            print(f"  fast:      {actual}")
+            sys.exit(1)
+    reference = run(checked, "reference")
+    fast = run(checked, "fast")
+    for number, (expected, actual) in enumerate(zip(reference, fast), start=1):
+        if expected != actual:
+            print(f"Mismatch on line {number}: {checked[number - 1]!r}")
+            print(f"  reference: {expected}")
+            print(f"  fast:      {actual}")
+            sys.exit(1)
+    print(f"golden check: {len(checked)} lines, identical output")
+
+    reference_rate = time_mode(lines, "reference", args.repeat)
+    fast_rate = time_mode(lines, "fast", args.repeat)
+    print(f"reference: {reference_rate:,.0f} lines/sec")
+    print(f"fast:      {fast_rate:,.0f} lines/sec ({fast_rate / reference_rate:.2f}x)")
+
+    write_report(new_report(
+        source=args.path or "synthetic",
+        lines=len(lines),
+        golden_lines=len(checked),
+        reference_lines_per_sec=round(reference_rate),
+        fast_lines_per_sec=round(fast_rate),
+        speedup=round(fast_rate / reference_rate, 2),
+    ), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Response serialization benchmark: time to encode and bytes on the wire.
+#
+#   python benchmarks/serialization_bench.py --voters 20000 --output results.json
+#
+# Encodes payloads shaped like the large responses (a voter list page, a
+# survey list with Firestore timestamps, a graph report) three ways: the
+# plain json JSONResponse the routes used before (timestamps converted by the
+# route), the same behind FastAPI's jsonable_encoder (routes that return
+# dicts), and FastJSONResponse. All must decode to the same data. Then the
+# encoded body is compressed the way CompressionMiddleware does it (gzip 6,
+# brotli 5), and with the maximum levels for comparison.
+import argparse
+import gzip
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+# Puts the repository on sys.path for the app modules below
+from bench_common import add_output_argument, new_report, write_report
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from responses import FastJSONResponse, orjson
+
+
+def voter_rows(count, seed=0):
+    # Like voter_row in main
+    rng = random.Random(seed)
+    return [{
+        "id": f"{number:020d}",
+        "fullName": f"DELA CRUZ, JUAN {rng.choice('ABCDEFGH')}. {number}",
+        "voterNo": str(1000000 + number),
+        "address": f"{rng.randrange(1, 999)} RIZAL ST., PUROK {rng.randrange(1, 9)}",
+        "barangay": f"BARANGAY {rng.randrange(1, 40)}",
+        "city": f"MUNICIPALITY {rng.randrange(1, 20)}",
+        "province": "PROVINCE 1",
+        "addressline2": "" if rng.random() < 0.8 else f"SITIO {rng.randrange(1, 9)}",
+    } for number in range(count)]
+
+
+def survey_rows(count, seed=0):
+    # Survey documents as Firestore returns them, created_at a timestamp
+    from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for number in range(count):
+        created_at = start + timedelta(seconds=rng.randrange(180 * 86400))
+        rows.append({
+            "candidateId": f"candidate{rng.randrange(10)}",
+            "electionId": "election1",
+            "surveyorId": f"surveyor{rng.randrange(200)}",
+            "precintList": f"{rng.randrange(500):04d}A",
+            "userDocumentId": f"voter{number}",
+            "age": str(rng.randint(18, 90)),
+            "gender": rng.choice(["Male", "Female"]),
+            "remarks": "",
+            "created_at": DatetimeWithNanoseconds(*created_at.timetuple()[:6], tzinfo=timezone.utc),
+        })
+    return rows
+
+
+def graph_report(count, seed=0):
+    # Shaped like /getGraphDetails/: per location totals with age and gender buckets
+    rng = random.Random(seed)
+    return [{
+        "candidateId": f"candidate{rng.randrange(10)}",
+        "Province": "PROVINCE 1",
+        "City": f"MUNICIPALITY {rng.randrange(1, 20)}",
+        "precintList": f"{number:04d}A",
+        "votes": rng.randrange(1000),
+        "ages": [str(rng.randint(18, 90)) for _ in range(rng.randrange(1, 40))],
+        "genders": [rng.choice(["Male", "Female"]) for _ in range(rng.randrange(1, 40))],
+    } for number in range(count)]
+
+
+def render_plain(content):
+    # Datetimes had to be converted by the routes first, as getSurveyById did
+    rows = []
+    for row in content:
+        if isinstance(row.get("created_at"), datetime):
+            row = dict(row, created_at=row["created_at"].isoformat())
+        rows.append(row)
+    return JSONResponse(rows).body
+
+
+def render_encoded(content):
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def render_fast(content):
+    return FastJSONResponse(content).body
+
+
+def best_time(function, content, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = function(content)
+        times.append(time.perf_counter() - started)
+    return min(times), body
+
+
+def compressed_sizes(body):
+    sizes = {"identity": len(body), "gzip_6": len(gzip.compress(body, 6)), "gzip_9": len(gzip.compress(body, 9))}
+    try:
+        import brotli
+    except ImportError:
+        return sizes
+    sizes["br_5"] = len(brotli.compress(body, mode=brotli.MODE_TEXT, quality=5))
+    sizes["br_11"] = len(brotli.compress(body, mode=brotli.MODE_TEXT, quality=11))
+    return sizes
+
+
+def measure(name, content, repeat):
+    plain_seconds, plain_body = best_time(render_plain, content, repeat)
+    encoded_seconds, encoded_body = best_time(render_encoded, content, repeat)
+    fast_seconds, fast_body = best_time(render_fast, content, repeat)
+    if not json.loads(plain_body) == json.loads(encoded_body) == json.loads(fast_body):
+        sys.exit(f"{name}: the encoders produce different data")
+
+    started = time.perf_counter()
+    gzip.compress(fast_body, 6)
+    gzip_seconds = time.perf_counter() - started
+    return {
+        "payload": name,
+        "rows": len(content),
+        "json_seconds": round(plain_seconds, 4),
+        "jsonable_encoder_seconds": round(encoded_seconds, 4),
+        "fast_seconds": round(fast_seconds, 4),
+        "speedup": round(plain_seconds / fast_seconds, 2),
+        "gzip_6_seconds": round(gzip_seconds, 4),
+        "bytes": compressed_sizes(fast_body),
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark response serialization and compression")
+    arg_parser.add_argument("--voters", type=int, default=20000, help="rows of the voter list payload")
+    arg_parser.add_argument("--surveys", type=int, default=20000, help="rows of the survey list payload")
+    arg_parser.add_argument("--graph-rows", type=int, default=2000, help="rows of the graph report payload")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="best of this many runs")
+    add_output_argument(arg_parser)
+    args = arg_parser.parse_args()
+
+    report = new_report(
+        orjson=orjson.__version__ if orjson is not None else None,
+        cases=[],
+    )
+    payloads = [
+        ("voters", voter_rows(args.voters)),
+        ("surveys", survey_rows(args.surveys)),
+        ("graph", graph_report(args.graph_rows)),
+    ]
+    for name, content in payloads:
+        case = measure(name, content, args.repeat)
+        report["cases"].append(case)
+        sizes = ", ".join(f"{encoding} {size}" for encoding, size in case["bytes"].items())
+        print(f"{name} ({case['rows']} rows): json {case['json_seconds']:.4f}s, jsonable_encoder+json "
+              f"{case['jsonable_encoder_seconds']:.4f}s, fast {case['fast_seconds']:.4f}s ({case['speedup']}x); bytes: {sizes}")
+
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
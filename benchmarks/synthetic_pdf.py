@@ -0,0 +1,113 @@
+# Synthetic COMELEC-style voter-list PDFs for the benchmarks.
+#
+#   python benchmarks/synthetic_pdf.py out.pdf --pages 200 --precincts 20 --voters-per-page 50
+#
+# Every page starts with the PROVINCE / CITY / BARANGAY / Prec header block of
+# its precinct, followed by voter lines in the three formats the parser
+# handles: numbered lines, asterisk-prefixed lines and numbered lines that
+# only the get_non_matching fallback can read. The PDF is written by hand
+# (Helvetica, WinAnsi text) so no PDF library is needed.
+import argparse
+import random
+
+LAST_NAMES = ["DELA CRUZ", "SANTOS", "REYES", "GARCIA", "BAUTISTA", "MENDOZA", "VILLANUEVA", "DE LEON", "CASTILLO", "RAMOS"]
+FIRST_NAMES = ["JUAN", "MARIA", "JOSE", "ANA", "PEDRO", "ROSARIO", "MA CRISTINA", "ANTONIO", "LUZVIMINDA", "RICARDO"]
+# Names the primary voter regex cannot read, so these lines use the fallback
+ACCENTED_NAMES = ["NUÑEZ", "PEÑA", "MUÑOZ", "IBAÑEZ", "ZUÑIGA"]
+PUROKS = ["PRK. 1", "PRK. 2 CENTRO", "PRK. 3", "PRK. 4 LOWER", "PRK. 5", "PRK. 6 UPPER"]
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+FONT_SIZE = 8
+LEADING = 10
+
+
+def voter_list_pages(pages, precincts, voters_per_page, asterisk_ratio=0.1, fallback_ratio=0.1, seed=0):
+    # Yields the text lines of each page
+    rng = random.Random(seed)
+    precincts = max(1, min(precincts, pages))
+    number = 0
+    for page in range(pages):
+        precinct = page * precincts // pages
+        if page == 0 or precinct != (page - 1) * precincts // pages:
+            number = 0
+        lines = [
+            "COMMISSION ON ELECTIONS",
+            f"PROVINCE : PROVINCE {precinct // 50 + 1}",
+            f"CITY / MUNICIPALITY : MUNICIPALITY {precinct // 10 + 1}",
+            f"BARANGAY : BARANGAY {precinct // 2 + 1}",
+            f"Prec : {precinct + 1:04d}A",
+            "No. Name Address",
+        ]
+        for _ in range(voters_per_page):
+            number += 1
+            last, first, middle = rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            purok = rng.choice(PUROKS)
+            kind = rng.random()
+            if kind < asterisk_ratio:
+                lines.append(f"* {last} {first} {middle} {purok}")
+            elif kind < asterisk_ratio + fallback_ratio:
+                lines.append(f"{number} {rng.choice(ACCENTED_NAMES)}, {first} {middle}, PUROK {rng.randint(1, 9)}")
+            else:
+                lines.append(f"{number} {last}, {first} {middle} {purok}")
+        lines.append(f"Page {page + 1} of {pages}")
+        yield lines
+
+
+def pdf_string(text):
+    data = text.encode("cp1252", errors="replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def write_pdf(pages, path):
+    # Objects 1-3 are the catalog, the page tree and the font; every page
+    # adds a content stream and a page object. The page tree is written last
+    # so pages can be streamed straight to the file.
+    offsets = {}
+    with open(path, "wb") as f:
+        def write_object(number, body):
+            offsets[number] = f.tell()
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+        kids = []
+        number = 4
+        for lines in pages:
+            content = b"BT /F1 %d Tf %d TL 36 %d Td\n" % (FONT_SIZE, LEADING, PAGE_HEIGHT - 36)
+            content += b"".join(pdf_string(line) + b" Tj T*\n" for line in lines)
+            content += b"ET"
+            write_object(number, b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+            write_object(number + 1, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (PAGE_WIDTH, PAGE_HEIGHT, number))
+            kids.append(number + 1)
+            number += 2
+
+        write_object(2, b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % kid for kid in kids) + b"] /Count %d >>" % len(kids))
+
+        xref_offset = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % number)
+        for object_number in range(1, number):
+            f.write(b"%010d 00000 n \n" % offsets[object_number])
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (number, xref_offset))
+
+
+def generate(path, pages, precincts, voters_per_page, seed=0):
+    write_pdf(voter_list_pages(pages, precincts, voters_per_page, seed=seed), path)
+    return path
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Write a synthetic COMELEC-style voter-list PDF")
+    arg_parser.add_argument("path")
+    arg_parser.add_argument("--pages", type=int, default=100)
+    arg_parser.add_argument("--precincts", type=int, default=10)
+    arg_parser.add_argument("--voters-per-page", type=int, default=50)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+    generate(args.path, args.pages, args.precincts, args.voters_per_page, args.seed)
+
+
+if __name__ == "__main__":
+    main()
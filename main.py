@@ -1,30 +1,107 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Query, Request, Body
+from pydantic import BaseModel, Field, ValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import firebase_admin
-from firebase_admin import credentials, firestore
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import base64
+import bisect
+import functools
+import hashlib
+import itertools
+import json
 import os
-from datetime import datetime
-from nltk import ne_chunk, pos_tag, word_tokenize
-from nltk.tree import Tree
+import random
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import logging
-import pdfplumber
-import re
-import nltk
-from typing import Optional
-from werkzeug.utils import secure_filename
-app = FastAPI()
-
-# Firebase initialization
-cred = credentials.Certificate("vels-d0547-firebase-adminsdk-6kni4-2d374ae1f1.json")
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+from typing import List, Optional
+from analytics import SurveyFrame, add_tally, survey_tally_updates, tally_values
+from voter_parser import LOCATION_FIELDS, iter_voter_information_cached
+# orjson-backed JSONResponse, also the default for routes returning plain data
+from responses import CompressionMiddleware, FastJSONResponse as JSONResponse, dumps
+from metrics import MetricsRoute, in_request_context, instrument_firestore, registry as metrics_registry, request_firestore_calls
+from sessions import SessionError, SessionSigner, check_password, hash_password, needs_rehash
+app = FastAPI(default_response_class=JSONResponse)
+# Every route records its latency, response size and Firestore calls, see /metrics
+app.router.route_class = MetricsRoute
+
+
+firebase_app_lock = threading.Lock()
+
+
+def init_firebase_app():
+    # The sync and the async client share one Firebase app
+    import firebase_admin
+    from firebase_admin import credentials
+
+    with firebase_app_lock:
+        try:
+            return firebase_admin.get_app()
+        except ValueError:
+            cred = credentials.Certificate("vels-d0547-firebase-adminsdk-6kni4-2d374ae1f1.json")
+            return firebase_admin.initialize_app(cred)
+
+
+def init_firestore_client():
+    # Firebase initialization. With FIRESTORE_EMULATOR_HOST set the client talks
+    # to a local Firestore emulator instead (used by the benchmarks)
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        from google.cloud import firestore
+        return firestore.Client(project=os.environ.get("GOOGLE_CLOUD_PROJECT", "vels-d0547"))
+
+    from firebase_admin import firestore
+    init_firebase_app()
+    return firestore.client()
+
+
+def init_async_firestore_client():
+    # Same as init_firestore_client, for the async routes
+    if os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        from google.cloud import firestore
+        return firestore.AsyncClient(project=os.environ.get("GOOGLE_CLOUD_PROJECT", "vels-d0547"))
+
+    from firebase_admin import firestore_async
+    init_firebase_app()
+    return firestore_async.client()
+
+
+class LazyFirestoreClient:
+    # Stands in for the Firestore client. The Firebase SDK (and gRPC with it)
+    # is only imported and initialized when a request first touches db, which
+    # keeps it out of the cold start.
+    def __init__(self, init_client=init_firestore_client):
+        self._init_client = init_client
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = instrument_firestore(self._init_client())
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
+
+
+db = LazyFirestoreClient()
+# Used by the async def routes so they never block the event loop
+async_db = LazyFirestoreClient(init_async_firestore_client)
 USERS_COLLECTION = "users"
 VOTERS_COLLECTION ="Voters"
 ELECTION_COLLECTION ="Election"
 ALLOCATE_COLLECTION ="allocate"
 SURVEY_COLLECTION ="Survey"
+# Vote tallies kept up to date by POST /surveys/, see survey_tally_updates
+SURVEY_TALLIES_COLLECTION = "SurveyTallies"
+SURVEY_GRAPH_TALLIES_COLLECTION = "SurveyGraphTallies"
 # CORS configuration
 app.add_middleware(
     CORSMiddleware,
@@ -32,10 +109,89 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Firestore-Round-Trips", "ETag", "X-Cache"],
 )
+# Responses of at least COMPRESSION_MIN_SIZE bytes go out brotli or gzip
+# compressed, whichever the client accepts
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.environ.get("COMPRESSION_MIN_SIZE", "1024")))
 
 # Ensure upload folder exists
 os.makedirs('uploads', exist_ok=True)
+# Uploads are copied to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Firestore allows at most 500 writes in one batch
+MAX_BATCH_WRITES = 500
+# Most surveys one POST /surveys/batch may carry
+MAX_SURVEY_BATCH = 2000
+BATCH_COMMIT_RETRIES = 5
+BATCH_RETRY_BASE_DELAY = 0.5
+# Ingestion job state, and how many uploads are loaded at the same time
+INGEST_JOBS_DIR = os.path.join('uploads', 'jobs')
+os.makedirs(INGEST_JOBS_DIR, exist_ok=True)
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+# Finished jobs are reported by GET /jobs/{id} for this many days, then their
+# job files are deleted, and with them the upload of a failed job
+INGEST_JOB_RETENTION_DAYS = float(os.environ.get("INGEST_JOB_RETENTION_DAYS", "7"))
+# What an upload does with precincts that are already in Firestore:
+#   fail           reject the upload before anything is written
+#   skip-existing  load only the new precincts
+#   replace        delete the voters of an existing precinct and load it again
+#   merge          update the existing voters, position by position, keeping
+#                  the fields added since (addressline2, updated_at, ...)
+INGEST_MODES = ("fail", "skip-existing", "replace", "merge")
+# Precinct documents fetched per get_all round trip
+PRECINCT_LOOKUP_CHUNK = 500
+# Users documents cached for the name lookups of the reporting endpoints
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", "300"))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get("USER_CACHE_MAX_ENTRIES", "10000"))
+USER_LOOKUP_CHUNK = 300
+# Only these fields are cached, never the password
+USER_PROFILE_FIELDS = ["username", "selectedMode", "candidateId", "status"]
+# Users fields no endpoint returns, see public_user
+PRIVATE_USER_FIELDS = ("password",)
+# Survey voters are joined with concurrent get_all calls of this many documents
+VOTER_LOOKUP_CHUNK = 300
+VOTER_LOOKUP_WORKERS = 4
+# The only voter fields the survey graphs use
+GRAPH_VOTER_FIELDS = ["Province", "City"]
+# Documents the summary tallies are split over (see add_survey_to_batch)
+SURVEY_TALLY_SHARDS = int(os.environ.get("SURVEY_TALLY_SHARDS", "10"))
+# Most Firestore calls an async route has in flight at once
+FIRESTORE_CONCURRENCY = int(os.environ.get("FIRESTORE_CONCURRENCY", "16"))
+# Page size of the list endpoints when only start_after is given, and the largest allowed
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# The precinct ID list is re-read after this many seconds even without ingestion
+# in this process, for uploads handled by other instances
+PRECINCT_CACHE_TTL = float(os.environ.get("PRECINCT_CACHE_TTL", "300"))
+# Report responses are recomputed after RESPONSE_CACHE_TTL seconds, or when the
+# data they depend on changes. A stale response is served for up to
+# RESPONSE_CACHE_STALE more seconds while it is recomputed in the background.
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "60"))
+RESPONSE_CACHE_STALE = float(os.environ.get("RESPONSE_CACHE_STALE", "30"))
+# Most responses kept, the least recently used go first
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+# What the report endpoints are built from
+REPORT_TAGS = ("surveys", "users", "elections")
+# With FIRESTORE_REPLICA=1 the Survey, Election and allocate collections are
+# kept in memory by snapshot listeners (see CollectionReplica). A listener
+# that stopped is restarted at most every REPLICA_RETRY seconds.
+FIRESTORE_REPLICA = os.environ.get("FIRESTORE_REPLICA", "").lower() in ("1", "true", "yes")
+REPLICA_RETRY = float(os.environ.get("REPLICA_RETRY", "30"))
+# /sync watermarks are this many seconds behind the server clock, so writes
+# that were in flight during a sync are sent again in the next one
+SYNC_WATERMARK_SLACK = float(os.environ.get("SYNC_WATERMARK_SLACK", "30"))
+# Session tokens, see sessions.py. SESSION_SECRET is a comma separated list:
+# the first secret signs, all of them verify. Without it every process makes
+# up its own, and tokens are only valid on the instance that issued them.
+SESSION_SECRETS = [secret for secret in os.environ.get("SESSION_SECRET", "").split(",") if secret]
+ACCESS_TOKEN_TTL = float(os.environ.get("ACCESS_TOKEN_TTL", "900"))
+REFRESH_TOKEN_TTL = float(os.environ.get("REFRESH_TOKEN_TTL", str(30 * 86400)))
+# PBKDF2 iterations of stored passwords: more makes every login slower, and
+# the hashes slower to crack. Passwords stored with another count (or in
+# plain text) are hashed again the next time their user signs in.
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", "260000"))
 
 class SigninData(BaseModel):
     email: str
@@ -81,6 +237,12 @@ class SurveyDetails(BaseModel):
     remarks: str
     
 
+class SurveyBatchItem(SurveyDetails):
+    # Chosen by the app when the survey is recorded and sent again on every
+    # retry, so the survey is only stored once. Never empty: every survey
+    # without a key would get the same document ID.
+    idempotencyKey: str = Field(..., min_length=1)
+
 
 @app.post('/signin')
 def signin(data: SigninData):
@@ -92,24 +254,34 @@ def signin(data: SigninData):
     if not email or not password:
         return JSONResponse(content={"error": "Missing data"}, status_code=400)
     
-    # Fetch user from Firestore
-    users_ref = db.collection(USERS_COLLECTION)
-    query = users_ref.where('email', '==', email).limit(1).get()
+    # Fetch user from Firestore, by ID when the email index knows it
+    user_snapshot = email_index.find(email)
 
-    if not query:
+    if user_snapshot is None:
         return JSONResponse(content={"error": "User not found"}, status_code=404)
     
-    user_doc = query[0].to_dict()
+    user_doc = user_snapshot.to_dict()
+    stored_password = user_doc.get('password')
     
     # Check if the provided password matches the stored password
-    if user_doc.get('password') == password:
+    if check_password(stored_password, password):
+        if needs_rehash(stored_password, PASSWORD_HASH_ITERATIONS):
+            try:
+                stored_password = hash_password(password, PASSWORD_HASH_ITERATIONS)
+                user_snapshot.reference.update({'password': stored_password})
+            except Exception as e:
+                # Signing in works with the old password entry as well
+                logging.error(f"Error rehashing the password of user {user_snapshot.id}: {e}")
+                stored_password = user_doc.get('password')
+
         # Return only the username and ID
         user_response = {
-            "id": query[0].id,  # Firestore document ID
+            "id": user_snapshot.id,  # Firestore document ID
             "username": user_doc.get('username'),
             "selectedMode": user_doc.get('selectedMode')
         }
-        return JSONResponse(content={"message": "Sign in successful", "user": user_response}, status_code=200)
+        tokens = session_signer.issue_pair(user_snapshot.id, session_claims(user_doc), stored_password)
+        return JSONResponse(content={"message": "Sign in successful", "user": user_response, **tokens}, status_code=200)
     else:
         return JSONResponse(content={"error": "Invalid credentials"}, status_code=401)
 
@@ -131,7 +303,7 @@ def signup(data: SignupData):
     user_data = {
         'username': username,
         'email': email,
-        'password': password,
+        'password': hash_password(password, PASSWORD_HASH_ITERATIONS),
         'contact': contact,
         'selectedMode': selectedMode,
     }
@@ -144,40 +316,162 @@ def signup(data: SignupData):
     users_ref = db.collection(USERS_COLLECTION)  
     new_user_ref = users_ref.document() 
     new_user_ref.set(user_data)
+    email_index.add(email, new_user_ref.id)
+    user_profiles.invalidate(new_user_ref.id)
+    report_cache.invalidate("users")
 
     # Return success message
     return JSONResponse(content={"message": "Signup successful"}, status_code=201)
 
 
+def encode_cursor(document_id):
+    return base64.urlsafe_b64encode(json.dumps({"after": document_id}).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["after"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid start_after cursor")
+
+
+class PageParams:
+    # ?limit=&start_after=&fields= of the list endpoints. fields is a comma
+    # separated list passed to select(). Without limit and start_after the
+    # whole collection is returned as before; with them documents come in ID
+    # order and the X-Next-Cursor header holds the start_after of the next
+    # page, as long as there may be one. Streamed responses end with a
+    # {"nextCursor": ...} line instead.
+    def __init__(
+        self,
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        start_after: Optional[str] = None,
+        fields: Optional[str] = None,
+    ):
+        self.paged = limit is not None or start_after is not None
+        self.limit = limit or DEFAULT_PAGE_SIZE
+        self.after = decode_cursor(start_after) if start_after else None
+        self.fields = [field.strip() for field in fields.split(",") if field.strip()] if fields is not None else None
+
+    def apply(self, query):
+        if self.fields is not None:
+            query = query.select(self.fields)
+        if not self.paged:
+            return query
+        query = query.order_by("__name__")
+        if self.after is not None:
+            query = query.start_after({"__name__": self.after})
+        return query.limit(self.limit)
+
+    def headers(self, docs):
+        if self.paged and len(docs) == self.limit:
+            return {"X-Next-Cursor": encode_cursor(docs[-1].id)}
+        return {}
+
+    def rows(self, docs, to_row):
+        count = 0
+        for doc in docs:
+            count += 1
+            last_id = doc.id
+            yield to_row(doc)
+        if self.paged and count == self.limit:
+            yield {"nextCursor": encode_cursor(last_id)}
+
+
+def wants_ndjson(request, stream=False):
+    # ?stream=true or Accept: application/x-ndjson
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def ndjson_response(rows, status_code=200, headers=None):
+    # One JSON document per line, encoded and sent while the rows come out of
+    # stream(), so memory stays flat and clients can render the first rows
+    # before the last ones are read
+    def lines():
+        try:
+            for row in rows:
+                yield dumps(row) + b"\n"
+        except Exception as e:
+            # The status line is already out, the error goes into the stream
+            logging.error(f"Error while streaming: {e}")
+            yield dumps({"error": str(e)}) + b"\n"
+    return StreamingResponse(lines(), status_code=status_code, media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+
+def public_user(user_data):
+    # A users document as the endpoints return it, without PRIVATE_USER_FIELDS
+    return {field: value for field, value in user_data.items() if field not in PRIVATE_USER_FIELDS}
+
+
 @app.get('/users')
-def get_all_users():
+def get_all_users(page: PageParams = Depends()):
     try:
+        # Passwords are never returned
+        if page.fields is not None:
+            page.fields = [field for field in page.fields if field not in PRIVATE_USER_FIELDS]
         users_ref = db.collection(USERS_COLLECTION)  
-        docs = users_ref.stream()
+        docs = list(page.apply(users_ref).stream())
 
         users = []
         for doc in docs:
-            user_data = doc.to_dict()
+            user_data = public_user(doc.to_dict())
             user_data['id'] = doc.id  # Add document ID to the data
             users.append(user_data)
 
-        return JSONResponse(content=users, status_code=200)
+        return JSONResponse(content=users, status_code=200, headers=page.headers(docs))
     except Exception as e:
         print(f"Error: {e}")
         return JSONResponse(content={"error": "Failed to retrieve users"}, status_code=500)
 
 
+class PrecinctIdCache:
+    # Sorted IDs of the precinct documents. They are read with a keys-only
+    # query (no document data is sent) and kept until ingestion writes new
+    # precincts or PRECINCT_CACHE_TTL runs out. list_documents() is not used
+    # because it also lists precincts whose voters are still being loaded.
+    def __init__(self, ttl=PRECINCT_CACHE_TTL):
+        self.ttl = ttl
+        self.ids = None
+        self.expires = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.ids is not None and self.expires > time.monotonic():
+                return self.ids
+            generation = self.generation
+
+        ids = sorted(doc.id for doc in db.collection(VOTERS_COLLECTION).select(["__name__"]).stream())
+        with self.lock:
+            # Not kept when ingestion invalidated the list while it was read
+            if generation == self.generation:
+                self.ids = ids
+                self.expires = time.monotonic() + self.ttl
+        return ids
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.ids = None
+
+
+precinct_ids = PrecinctIdCache()
+
+
 @app.get('/precints')
-def get_all_precints():
+def get_all_precints(page: PageParams = Depends()):
     try:
-        # Fetch all documents from the collection
-        users_ref = db.collection(VOTERS_COLLECTION)
-        docs = users_ref.stream()
-        logging.info(f"users_ref: {users_ref}")
-        # Extract document IDs
-        doc_ids = [doc.id for doc in docs]
-
-        return JSONResponse(content={"doc_ids": doc_ids}, status_code=200)
+        # Precinct IDs come from the in-memory list, pages are cut from it
+        doc_ids = precinct_ids.get()
+        headers = {}
+        if page.paged:
+            start = bisect.bisect_right(doc_ids, page.after) if page.after is not None else 0
+            doc_ids = doc_ids[start:start + page.limit]
+            if len(doc_ids) == page.limit:
+                headers["X-Next-Cursor"] = encode_cursor(doc_ids[-1])
+
+        return JSONResponse(content={"doc_ids": doc_ids}, status_code=200, headers=headers)
     
     except Exception as e:
         print(f"Error: {e}")
@@ -199,7 +493,8 @@ def update_voter_address(precinct_id: str, document_id: str, data: AddressUpdate
 
         # Update the document by adding the new field 'addressline2'
         doc_ref.update({
-            'addressline2': addressline2
+            'addressline2': addressline2,
+            'updated_at': datetime.utcnow().isoformat()  # For /sync
         })
 
         return JSONResponse(content={"message": "Address updated successfully"}, status_code=200)
@@ -207,8 +502,25 @@ def update_voter_address(precinct_id: str, document_id: str, data: AddressUpdate
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
+def voter_row(doc, precinct_data):
+    voter_data = add_precinct_location(doc.to_dict(), precinct_data)
+    voter_data['id'] = doc.id  # Add document ID to the voter data
+    
+    # Optional voter fields, defaulting to a message if not found
+    return {
+        "id": voter_data.get("id", "ID not found"),
+        "fullName": voter_data.get("Full Name", "Full Name not found"),
+        "voterNo": voter_data.get("Voter No", "Voter No not found"),
+        "address": voter_data.get("Address", "Address not found"),
+        "barangay": voter_data.get("Barangay", "Barangay not found"),
+        "city": voter_data.get("City", "City not found"),
+        "province": voter_data.get("Province", "Province not found"),
+        "addressline2": voter_data.get("addressline2", "")
+    }
+
+
 @app.get('/users/{doc_id}/voters')
-def get_voters_by_documentid(doc_id: str):
+def get_voters_by_documentid(doc_id: str, request: Request, page: PageParams = Depends(), stream: bool = False):
     try:
         # Reference to the specific user document
         user_ref = db.collection(VOTERS_COLLECTION).document(doc_id)  
@@ -217,32 +529,18 @@ def get_voters_by_documentid(doc_id: str):
         user_doc = user_ref.get()
 
         if user_doc.exists:
+            precinct_data = user_doc.to_dict()
             # Reference to the voters sub-collection
             voters_ref = user_ref.collection('voters')
             
-            # Fetch all voter documents
-            docs = voters_ref.stream()
-
-            voters = []
-            for doc in docs:
-                voter_data = doc.to_dict()
-                voter_data['id'] = doc.id  # Add document ID to the voter data
-                
-                # Optional voter fields, defaulting to a message if not found
-                voter_info = {
-                    "id": voter_data.get("id", "ID not found"),
-                    "fullName": voter_data.get("Full Name", "Full Name not found"),
-                    "voterNo": voter_data.get("Voter No", "Voter No not found"),
-                    "address": voter_data.get("Address", "Address not found"),
-                    "barangay": voter_data.get("Barangay", "Barangay not found"),
-                    "city": voter_data.get("City", "City not found"),
-                    "province": voter_data.get("Province", "Province not found"),
-                    "addressline2": voter_data.get("addressline2", "")
-                }
-
-                voters.append(voter_info)
-
-            return JSONResponse(content=voters, status_code=200)
+            if wants_ndjson(request, stream):
+                return ndjson_response(page.rows(page.apply(voters_ref).stream(), lambda doc: voter_row(doc, precinct_data)))
+
+            # Fetch the voter documents of this page
+            docs = list(page.apply(voters_ref).stream())
+            voters = [voter_row(doc, precinct_data) for doc in docs]
+
+            return JSONResponse(content=voters, status_code=200, headers=page.headers(docs))
         else:
             return JSONResponse(content={"error": "User not found"}, status_code=404)
     except Exception as e:
@@ -251,192 +549,572 @@ def get_voters_by_documentid(doc_id: str):
 
 
 
-def extract_voter_information_from_pdf(pdf_path):
-    # Initialize variables
-    precinct_voters = {}
-    results = {}
+def retryable_firestore_errors():
+    # Contention and overload errors worth retrying a commit for
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.Aborted,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+    )
+
+
+class FirestoreBatchWriter:
+    # Collects writes and commits them in batches of up to MAX_BATCH_WRITES,
+    # retrying a batch when Firestore reports contention or is overloaded
+    def __init__(self, client, batch_size=MAX_BATCH_WRITES, max_retries=BATCH_COMMIT_RETRIES):
+        self.client = client
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.batch = client.batch()
+        self.pending = 0
+        self.written = 0
+        self.commits = 0
+        self.retries = 0
+        self.started = time.monotonic()
+
+    def set(self, ref, data, merge=False):
+        self.batch.set(ref, data, merge=merge)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def create(self, ref, data):
+        # Fails the whole batch with AlreadyExists when ref exists
+        self.batch.create(ref, data)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def delete(self, ref):
+        self.batch.delete(ref)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if not self.pending:
+            return
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.batch.commit()
+                break
+            except retryable_firestore_errors() as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                delay = min(BATCH_RETRY_BASE_DELAY * 2 ** attempt, 10) * (1 + random.random())
+                logging.warning(f"Batch commit failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+        self.written += self.pending
+        self.commits += 1
+        self.batch = self.client.batch()
+        self.pending = 0
+
+
+async def gather_limited(coroutines, limit=FIRESTORE_CONCURRENCY):
+    # asyncio.gather, with at most limit of the coroutines running at a time
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+def get_all_documents(refs, field_paths=None, chunk_size=VOTER_LOOKUP_CHUNK):
+    # De-duplicated, chunked get_all calls, VOTER_LOOKUP_WORKERS at a time.
+    # Returns {document path: data} for the documents that exist.
+    refs = list({ref.path: ref for ref in refs}.values())
+    chunks = [refs[start:start + chunk_size] for start in range(0, len(refs), chunk_size)]
+    documents = {}
+    if not chunks:
+        return documents
+    with ThreadPoolExecutor(max_workers=min(VOTER_LOOKUP_WORKERS, len(chunks))) as executor:
+        for snapshots in executor.map(in_request_context(lambda chunk: list(db.get_all(chunk, field_paths=field_paths))), chunks):
+            for snapshot in snapshots:
+                if snapshot.exists:
+                    documents[snapshot.reference.path] = snapshot.to_dict()
+    return documents
+
+
+class UserProfileCache:
+    # Process-wide LRU cache of user profiles (USER_PROFILE_FIELDS of the users
+    # documents) with a TTL. Missing users are cached too, as None. Misses are
+    # fetched together with get_all, so a report resolves all its names in a
+    # few round trips instead of one read per row.
+    def __init__(self, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # user ID -> (expires at, profile or None)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, user_ids):
+        # Returns the cached profiles and the user IDs that have to be fetched
+        now = time.monotonic()
+        profiles = {}
+        missing = []
+        with self.lock:
+            for user_id in dict.fromkeys(user_ids):
+                if not user_id:
+                    profiles[user_id] = None
+                    continue
+                entry = self.entries.get(user_id)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(user_id)
+                    profiles[user_id] = entry[1]
+                    self.hits += 1
+                else:
+                    missing.append(user_id)
+                    self.misses += 1
+        return profiles, missing
+
+    def store(self, fetched):
+        with self.lock:
+            expires = time.monotonic() + self.ttl
+            for user_id, profile in fetched.items():
+                self.entries[user_id] = (expires, profile)
+                self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_many(self, user_ids):
+        profiles, missing = self.lookup(user_ids)
+        for start in range(0, len(missing), USER_LOOKUP_CHUNK):
+            chunk = missing[start:start + USER_LOOKUP_CHUNK]
+            fetched = dict.fromkeys(chunk)
+            refs = [db.collection(USERS_COLLECTION).document(user_id) for user_id in chunk]
+            for snapshot in db.get_all(refs, field_paths=USER_PROFILE_FIELDS):
+                if snapshot.exists:
+                    fetched[snapshot.id] = snapshot.to_dict()
+            profiles.update(fetched)
+            self.store(fetched)
+        return profiles
+
+    async def get_many_async(self, user_ids):
+        # get_many on async_db, with the chunks fetched concurrently
+        profiles, missing = self.lookup(user_ids)
+
+        async def fetch(chunk):
+            fetched = dict.fromkeys(chunk)
+            refs = [async_db.collection(USERS_COLLECTION).document(user_id) for user_id in chunk]
+            async for snapshot in async_db.get_all(refs, field_paths=USER_PROFILE_FIELDS):
+                if snapshot.exists:
+                    fetched[snapshot.id] = snapshot.to_dict()
+            self.store(fetched)
+            return fetched
+
+        chunks = [missing[start:start + USER_LOOKUP_CHUNK] for start in range(0, len(missing), USER_LOOKUP_CHUNK)]
+        for fetched in await gather_limited(fetch(chunk) for chunk in chunks):
+            profiles.update(fetched)
+        return profiles
+
+    def get(self, user_id):
+        return self.get_many([user_id])[user_id]
+
+    def invalidate(self, user_id=None):
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(user_id, None)
+
 
-    # Regular expressions to extract precinct, city, province, and barangay
-    prec_regex = re.compile(r'Prec\s*:\s*(\d+\w?)')
-    city_regex = re.compile(r'CITY / MUNICIPALITY : (.+)')
-    province_regex = re.compile(r'PROVINCE : (.+)')
-    barangay_line_regex = re.compile(r'BARANGAY : (.+)')
-    
-    # Regex to extract names with an asterisk followed by a space
-    asterisk_name_regex = re.compile(r'\*\s+([A-Z]+(?:\s[A-Z]+)*)\s+([A-Z]+(?:\s[A-Z]+)*)\s+([A-Z]+(?:\s[A-Z]+)*)\s+(PRK\.?\s+.+)', re.IGNORECASE)
-    # Regex to capture general voter information with or without prefix, including commas
-    voter_info_regex = re.compile(r'(\d+)?\s*[*]?\s*([A-Z]+(?:\s[A-Z]+)*),?\s+([A-Z]+(?:\s[A-Z]+)*)\s+([A-Z]+(?:\s[A-Z]+)*)\s+(PRK\.?\s+.+)', re.IGNORECASE)
-    # Regex to capture lines starting with a number
-    number_start_regex = re.compile(r'^\d+\s+')
-
-    final_add = {
-        'PRK.',
-        'CENTRO',
-        'PUROK',
-        'RK',
-        'RK.',
-        'PRK.1',
-        'PRPK.'
-    }
+user_profiles = UserProfileCache()
 
-    def convert_line_to_list(line):
-        # Define the pattern to split the line based on commas
-        parts = [part.strip() for part in line.split(',')]
-        return parts
-
-    def seprate_number_name(numberName):
-        onlyNumber = re.findall(r'\b\d+\b', numberName)
-        return onlyNumber
-
-    def remove_number(number_name, only_numbers):
-        # Remove all found numbers from the input string
-        for num in only_numbers:
-            number_name = number_name.replace(num, "").strip()
-        return number_name
-
-    def extract_only_number_firstName(data):
-        onlyNumber = seprate_number_name(data)
-        final = remove_number(data, onlyNumber)
-        firstName = ""
-        remove_special = final.split(" ")
-        if len(remove_special) > 1:
-            firstName = remove_special[1]
-        else:
-            firstName = remove_special[0]
-        return onlyNumber, firstName
-
-    def split_address(address):
-        parts = [part.strip() for part in address.split(',')]
-        final_parts = []
-        for part in parts:
-            sub_parts = [sub_part for sub_part in part.split() if sub_part]
-            final_parts.extend(sub_parts)
-        return final_parts
-
-    def split_array(arr, final_add):
-        final_add_set = set(final_add)
-        split_index = None
-        for i, item in enumerate(arr):
-            if item in final_add_set:
-                split_index = i
-                break
-        if split_index is None:
-            return [arr, []]
-        first_part = arr[:split_index]
-        second_part = arr[split_index:]
-        return [first_part, second_part]
-
-    # Function to extract voter information from a line
-    def extract_voter_info(line, barangay):
-        match = voter_info_regex.match(line)
-        if match:
-            voter_no = match.group(1) if match.group(1) else ""
-            last_name = match.group(2)
-            first_name = match.group(3)
-            middle_name = match.group(4)
-            address = match.group(5)
-            full_name = f"{last_name} {first_name} {middle_name}".strip()
-            return [voter_no, full_name, address, barangay]
-        return None
 
-    def get_non_matching(result):
-        # Initialize variables
-        final_address = []
-        main_data = []
+class EmailIndex:
+    # email -> users document ID, so /signin reads its user by ID instead of
+    # querying on email. Filled as it goes: /signup adds its user, and an
+    # email it does not know (a user added through another instance, or
+    # before this one started) is looked up with the query once and then
+    # remembered. Nothing is loaded at startup, to keep cold starts cheap.
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
 
-        # Convert the result to a formatted list
-        formatted_list = convert_line_to_list(result)
+    def add(self, email, user_id):
+        with self.lock:
+            self.ids.setdefault(email, user_id)
 
-        # Extract relevant data
-        precint_no = formatted_list[0]
-        onlyNumber, firstName = extract_only_number_firstName(formatted_list[1])
+    def find(self, email):
+        # The users document snapshot with this email, or None
+        with self.lock:
+            user_id = self.ids.get(email)
+        if user_id is not None:
+            snapshot = db.collection(USERS_COLLECTION).document(user_id).get()
+            if snapshot.exists and snapshot.get('email') == email:
+                return snapshot
+            # Deleted, or its email changed
+            with self.lock:
+                if self.ids.get(email) == user_id:
+                    del self.ids[email]
 
-        # Split the address
-        get_address = split_address(formatted_list[2])
+        query = db.collection(USERS_COLLECTION).where('email', '==', email).limit(1).get()
+        if not query:
+            return None
+        self.add(email, query[0].id)
+        return query[0]
 
-        # Determine how to handle the address
-        if len(get_address) == 1:
-            final_address = formatted_list[2] + " " + formatted_list[3]
-            final_address = final_address.split(" ")
-        else:
-            final_address = get_address
 
-        # Separate address parts
-        seprating_address = split_array(final_address, final_add)
+email_index = EmailIndex()
 
-        # Extract middle name/last name and address info
-        middle_name_last_name = seprating_address[0]
-        address_info = seprating_address[1]
 
-        # Concatenate first name with middle name/last name
-        fullname = " ".join([firstName] + middle_name_last_name)
-        address_data = " ".join(address_info)
-        
-        return onlyNumber[0], fullname, address_data
-
-    # Open the PDF file
-    with pdfplumber.open(pdf_path) as pdf:
-        city = province = barangay = ""
-        current_precinct = ""
-        for page in pdf.pages:
-            text = page.extract_text()
-            lines = text.split("\n")
-            for line in lines:
-                # Check and extract precinct number
-                prec_match = prec_regex.search(line)
-                if prec_match:
-                    current_precinct = prec_match.group(1)
-                    if current_precinct not in precinct_voters:
-                        precinct_voters[current_precinct] = []
-
-                # Check and extract city, province, and barangay
-                city_match = city_regex.search(line)
-                if city_match:
-                    city = city_match.group(1)
-                province_match = province_regex.search(line)
-                if province_match:
-                    province = province_match.group(1)
-                barangay_match = barangay_line_regex.search(line)
-                if barangay_match:
-                    barangay = barangay_match.group(1)
-
-                # Extract voter information and store it under the current precinct
-                voter_info = extract_voter_info(line, barangay)
-                if voter_info:
-                    # Add city and province to the voter info
-                    voter_info.extend([city, province])
-                    precinct_voters[current_precinct].append(voter_info)
-                else:
-                    # Check if the line starts with a number and does not match the primary format
-                    if number_start_regex.match(line):
-                        formatted_result = f"{current_precinct}, {line}, {barangay}, {city}, {province}"
-                        onlyNumber, fullname, address_info = get_non_matching(formatted_result)
-                        voter_info = [onlyNumber, fullname, address_info, barangay, city, province]
-                        precinct_voters[current_precinct].append(voter_info)
-
-                # Extract names with an asterisk followed by a space and store them
-                asterisk_name_match = asterisk_name_regex.match(line)
-                if asterisk_name_match:
-                    last_name = asterisk_name_match.group(1)
-                    first_name = asterisk_name_match.group(2)
-                    middle_name = asterisk_name_match.group(3)
-                    address = asterisk_name_match.group(4)
-                    full_name = f"{last_name} {first_name} {middle_name}".strip()
-                    voter_info = ['', full_name, address, barangay]  
-                    voter_info.extend([city, province])
-                    if current_precinct not in precinct_voters:
-                        precinct_voters[current_precinct] = []
-                    precinct_voters[current_precinct].append(voter_info)
-
-    # Process and store the extracted data in the results dictionary
-    for precinct, voters in precinct_voters.items():
-        results[precinct] = {
-            "precinct": precinct,
-            "total_voters": len(voters),
-            "voters": [dict(zip(["Voter No", "Full Name", "Address", "Barangay", "City", "Province"], voter)) for voter in voters]
+if not SESSION_SECRETS:
+    logging.warning("SESSION_SECRET is not set, session tokens will not survive a restart")
+session_signer = SessionSigner(SESSION_SECRETS or [secrets.token_urlsafe(32)], ACCESS_TOKEN_TTL, REFRESH_TOKEN_TTL)
+
+
+def session_claims(user_doc):
+    # What an access token says about its user besides the ID
+    return {"username": user_doc.get('username'), "selectedMode": user_doc.get('selectedMode')}
+
+
+def session_user(request: Request):
+    # Dependency for routes that need to know the caller: the claims of the
+    # request's bearer access token, checked without a Firestore read
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Missing bearer token", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return session_signer.verify(token.strip(), "access")
+    except SessionError as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+
+
+class RefreshData(BaseModel):
+    refreshToken: str
+
+
+@app.post('/token/refresh')
+def refresh_session(data: RefreshData):
+    # A new token pair for a valid refresh token whose user still exists and
+    # has not changed password since
+    try:
+        claims = session_signer.verify(data.refreshToken, "refresh")
+    except SessionError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=401)
+
+    try:
+        user_snapshot = db.collection(USERS_COLLECTION).document(claims['sub']).get()
+    except Exception as e:
+        logging.error(f"Error refreshing session: {e}")
+        return JSONResponse(content={"error": "Failed to refresh session"}, status_code=500)
+    user_doc = user_snapshot.to_dict() if user_snapshot.exists else None
+    if user_doc is None or claims.get('pwd') != session_signer.fingerprint(user_doc.get('password')):
+        return JSONResponse(content={"error": "Session ended"}, status_code=401)
+
+    tokens = session_signer.issue_pair(user_snapshot.id, session_claims(user_doc), user_doc.get('password'))
+    return JSONResponse(content=tokens, status_code=200)
+
+
+@app.get('/session')
+def get_session(session: dict = Depends(session_user)):
+    # Who the bearer token belongs to
+    return JSONResponse(content={"id": session['sub'], "username": session.get('username'),
+                                 "selectedMode": session.get('selectedMode'), "expiresAt": session['exp']}, status_code=200)
+
+
+def get_username(user_id, profiles, default="Unknown"):
+    profile = profiles.get(user_id)
+    return profile.get("username", default) if profile else default
+
+
+class ResponseCache:
+    # Finished 200 responses of the report endpoints, by path and the values
+    # of the parameters the endpoint declares (anything else in the query
+    # string is ignored), with an ETag so a client that already has the
+    # result gets a 304. At most max_entries are kept, least recently used
+    # out first, and an entry is dropped once it is past stale_until.
+    # Every entry depends on tags; a write to one of them makes the entries
+    # that depend on it stale. A stale entry is still served (X-Cache: stale)
+    # while one background refresh recomputes it, for up to stale seconds;
+    # after that the request recomputes it itself. Writes handled by other
+    # instances are only seen when ttl runs out.
+    def __init__(self, ttl=RESPONSE_CACHE_TTL, stale=RESPONSE_CACHE_STALE, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> {"tags", "body", "headers", "etag", "expires", "stale_until"}
+        self.generations = {}  # tag -> number of invalidations
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="response-cache")
+
+    def cached(self, *tags):
+        # Decorator for an endpoint that takes request: Request
+        def decorator(endpoint):
+            @functools.wraps(endpoint)
+            def wrapper(request: Request, **kwargs):
+                key = f"{request.url.path}?{sorted(kwargs.items())}"
+                return self.respond(request, key, tags, lambda: endpoint(request=request, **kwargs))
+            return wrapper
+        return decorator
+
+    def respond(self, request, key, tags, compute):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["stale_until"] <= now:
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+            if entry is not None and entry["expires"] > now:
+                state = "hit"
+            elif entry is not None:
+                state = "stale"
+                if key not in self.refreshing:
+                    self.refreshing.add(key)
+                    self.executor.submit(self.refresh_in_background, key, tags, compute)
+            else:
+                state = "miss"
+
+        if state == "miss":
+            generations = self.get_generations(tags)
+            response = compute()
+            entry = self.store(key, tags, generations, response)
+            if entry is None:
+                return response
+        headers = {**entry["headers"], "ETag": entry["etag"], "Cache-Control": "no-cache", "X-Cache": state}
+        known = {etag.strip().removeprefix("W/") for etag in request.headers.get("if-none-match", "").split(",")}
+        if entry["etag"] in known or "*" in known:
+            return Response(status_code=304, headers=headers)
+        if state == "miss":
+            response.headers.update(headers)
+            return response
+        return Response(content=entry["body"], status_code=200, headers=headers, media_type=entry["media_type"])
+
+    def get_generations(self, tags):
+        with self.lock:
+            return [self.generations.get(tag, 0) for tag in tags]
+
+    def store(self, key, tags, generations, response):
+        # Caches a response computed from the data at generations (see
+        # get_generations). Returns the entry, or None when it is not cacheable.
+        if response.status_code != 200 or not hasattr(response, "body"):
+            return None
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name not in ("content-length", "content-type", "x-firestore-round-trips")
         }
+        entry = {
+            "tags": tags,
+            "body": response.body,
+            "media_type": response.media_type,
+            "headers": headers,
+            "etag": '"' + hashlib.sha1(response.body).hexdigest() + '"',
+        }
+        now = time.monotonic()
+        with self.lock:
+            if generations == [self.generations.get(tag, 0) for tag in tags]:
+                entry["expires"] = now + self.ttl
+                entry["stale_until"] = entry["expires"] + self.stale
+            else:
+                # Invalidated while it was computed: newer than the cached
+                # response, but already stale
+                entry["expires"] = now
+                entry["stale_until"] = now + self.stale
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            for expired in [cached_key for cached_key, cached in self.entries.items() if cached["stale_until"] <= now]:
+                del self.entries[expired]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def refresh_in_background(self, key, tags, compute):
+        try:
+            generations = self.get_generations(tags)
+            self.store(key, tags, generations, compute())
+        except Exception as e:
+            logging.error(f"Error refreshing {key}: {e}")
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def invalidate(self, *tags):
+        now = time.monotonic()
+        with self.lock:
+            for tag in tags:
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+            for entry in self.entries.values():
+                if set(entry["tags"]) & set(tags):
+                    entry["expires"] = min(entry["expires"], now)
+                    entry["stale_until"] = min(entry["stale_until"], now + self.stale)
+
+
+report_cache = ResponseCache()
+
+
+class CollectionReplica:
+    # In-memory copy of a collection, kept up to date by an on_snapshot
+    # listener, with a hash index per tuple of fields in indexes. Every new
+    # listener starts with a full snapshot, after that only the changes are
+    # applied. find() serves equality queries from an index while the
+    # listener is running and falls back to a Firestore query otherwise.
+    def __init__(self, collection, indexes):
+        self.collection = collection
+        self.indexes = {fields: {} for fields in indexes}  # fields -> {values: set of IDs}
+        self.docs = {}
+        self.watch = None
+        self.generation = 0  # of the current listener
+        self.synced = False
+        self.started_at = -REPLICA_RETRY
+        self.starts = 0
+        self.read_time = None
+        self.lag = None
+        self.lock = threading.Lock()
+
+    def start(self, min_interval=0):
+        with self.lock:
+            if time.monotonic() - self.started_at < min_interval:
+                return
+            previous, self.watch = self.watch, None
+            self.generation += 1
+            self.synced = False
+            self.started_at = time.monotonic()
+            self.starts += 1
+            generation = self.generation
+        if previous is not None:
+            previous.unsubscribe()
+        # The listener calls on_snapshot from its own thread, which takes the lock
+        watch = db.collection(self.collection).on_snapshot(lambda *snapshot: self.on_snapshot(generation, *snapshot))
+        with self.lock:
+            if generation == self.generation:
+                self.watch = watch
+                return
+        watch.unsubscribe()
+
+    def stop(self):
+        with self.lock:
+            previous, self.watch = self.watch, None
+            self.generation += 1
+            self.synced = False
+        if previous is not None:
+            previous.unsubscribe()
+
+    def on_snapshot(self, generation, documents, changes, read_time):
+        with self.lock:
+            # Late snapshots of a listener that was replaced
+            if generation != self.generation:
+                return
+            if not self.synced:
+                # First snapshot of this listener: everything is replaced
+                self.docs = {}
+                for index in self.indexes.values():
+                    index.clear()
+                for document in documents:
+                    self.add(document.id, document.to_dict())
+                self.synced = True
+            else:
+                for change in changes:
+                    self.remove(change.document.id)
+                    if change.type.name != "REMOVED":
+                        self.add(change.document.id, change.document.to_dict())
+            self.read_time = read_time
+            # How far behind Firestore the replica was when this snapshot arrived
+            if read_time is not None:
+                self.lag = max(0.0, time.time() - read_time.timestamp())
+
+    def add(self, doc_id, data):
+        self.docs[doc_id] = data
+        for fields, index in self.indexes.items():
+            try:
+                index.setdefault(tuple(data.get(field) for field in fields), set()).add(doc_id)
+            except TypeError:
+                pass  # Unhashable values (lists, maps) are not indexed
+
+    def remove(self, doc_id):
+        data = self.docs.pop(doc_id, None)
+        if data is None:
+            return
+        for fields, index in self.indexes.items():
+            try:
+                key = tuple(data.get(field) for field in fields)
+                index[key].discard(doc_id)
+                if not index[key]:
+                    del index[key]
+            except (KeyError, TypeError):
+                pass
+
+    def ready(self):
+        if not FIRESTORE_REPLICA:
+            return False
+        watch = self.watch
+        if watch is not None and watch.is_active:
+            return self.synced
+        if time.monotonic() - self.started_at >= REPLICA_RETRY:
+            logging.warning(f"Snapshot listener of {self.collection} is not running, restarting it")
+            self.start(min_interval=REPLICA_RETRY)
+        return False
+
+    def lookup_items(self, **filters):
+        # (document ID, data) of the documents whose fields equal filters, in
+        # document ID order, from the index on exactly those fields. Only
+        # valid while ready().
+        fields = next(fields for fields in self.indexes if set(fields) == set(filters))
+        with self.lock:
+            doc_ids = sorted(self.indexes[fields].get(tuple(filters[field] for field in fields), ()))
+            return [(doc_id, dict(self.docs[doc_id])) for doc_id in doc_ids]
+
+    def lookup(self, **filters):
+        return [data for _, data in self.lookup_items(**filters)]
+
+    def find(self, **filters):
+        if self.ready():
+            return self.lookup(**filters)
+        query = db.collection(self.collection)
+        for field, value in filters.items():
+            query = query.where(field, '==', value)
+        return (doc.to_dict() for doc in query.stream())
+
+    def status(self):
+        with self.lock:
+            return {
+                "ready": FIRESTORE_REPLICA and self.synced and self.watch is not None and self.watch.is_active,
+                "documents": len(self.docs),
+                "readTime": self.read_time.isoformat() if self.read_time is not None else None,
+                "lagSeconds": self.lag,
+                "listenersStarted": self.starts,
+            }
+
+
+survey_replica = CollectionReplica(SURVEY_COLLECTION, [("surveyorId", "electionId", "precintList"), ("userDocumentId",)])
+election_replica = CollectionReplica(ELECTION_COLLECTION, [("electionId",)])
+allocate_replica = CollectionReplica(ALLOCATE_COLLECTION, [("isOpen", "surveyorId")])
+replicas = [survey_replica, election_replica, allocate_replica]
+
+
+@app.on_event("startup")
+def start_replicas():
+    if FIRESTORE_REPLICA:
+        for replica in replicas:
+            replica.start()
+
+
+@app.on_event("shutdown")
+def stop_replicas():
+    for replica in replicas:
+        replica.stop()
+
+
+@app.get('/metrics')
+def get_metrics():
+    # Prometheus text format
+    return Response(content=metrics_registry.expose(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-    return results
+
+@app.get('/replica/status')
+def replica_status():
+    return JSONResponse(content={
+        "enabled": FIRESTORE_REPLICA,
+        "collections": {replica.collection: replica.status() for replica in replicas},
+    }, status_code=200)
 
 
 def allowed_file(filename):
@@ -446,8 +1124,452 @@ def allowed_file(filename):
 
 
 
+def voter_document_id(precinct, number):
+    # Deterministic but evenly spread IDs: a resumed job or a retried upload
+    # overwrites the voters already written instead of adding them twice, and
+    # "merge" updates the voter at the same position of the list
+    return hashlib.sha1(f"{precinct}/{number}".encode()).hexdigest()[:20]
+
+
+def voter_document(voter, location):
+    # Barangay, City and Province are stored once on the precinct document,
+    # a voter document only keeps the ones that differ from its precinct
+    document = {"Voter No": voter.number, "Full Name": voter.name, "Address": voter.address}
+    if voter.location != location:
+        for field, value, precinct_value in zip(LOCATION_FIELDS, voter.location, location):
+            if value != precinct_value:
+                document[field] = value
+    return document
+
+
+def legacy_voter_ids(precinct_ref, precinct):
+    # Precincts loaded before voter_document_id have random voter document
+    # IDs, which surveys refer to. Returns {(Voter No, Full Name): document
+    # ID} of those voters (some have no Voter No) so "merge" updates them in
+    # place, or {} when the precinct uses voter_document_id (its first voter
+    # is where that puts it).
+    voters_ref = precinct_ref.collection('voters')
+    if voters_ref.document(voter_document_id(precinct, 1)).get(field_paths=['Voter No']).exists:
+        return {}
+    return {(doc.get('Voter No'), doc.get('Full Name')): doc.id for doc in voters_ref.select(['Voter No', 'Full Name']).stream()}
+
+
+def merged_voter_document(voter, location):
+    # voter_document for a merge write: location fields the voter no longer
+    # needs (now the same as its precinct's) are removed, not left behind
+    from google.cloud.firestore import DELETE_FIELD
+
+    document = voter_document(voter, location)
+    for field in LOCATION_FIELDS:
+        document.setdefault(field, DELETE_FIELD)
+    return document
+
+
+def add_precinct_location(voter_data, precinct_data):
+    # Voters written since the location moved to the precinct document
+    # (older voter documents still carry all three fields)
+    for field in LOCATION_FIELDS:
+        if field not in voter_data and field in precinct_data:
+            voter_data[field] = precinct_data[field]
+    return voter_data
+
+
+def get_survey_voters(surveys):
+    # Bulk join of surveys with their voters, GRAPH_VOTER_FIELDS only.
+    # Returns {(precinct, voter document ID): voter data}.
+    keys = {(survey.get('precintList'), survey.get('userDocumentId')) for survey in surveys}
+    refs = {
+        (precinct, voter_id): db.collection(VOTERS_COLLECTION).document(precinct).collection('voters').document(voter_id)
+        for precinct, voter_id in keys if precinct and voter_id
+    }
+    documents = get_all_documents(refs.values(), field_paths=GRAPH_VOTER_FIELDS)
+    voters = {key: documents[ref.path] for key, ref in refs.items() if ref.path in documents}
+
+    # Newer voters keep their location on the precinct document
+    precinct_refs = {
+        precinct: db.collection(VOTERS_COLLECTION).document(precinct)
+        for (precinct, _), data in voters.items() if any(field not in data for field in GRAPH_VOTER_FIELDS)
+    }
+    precincts = get_all_documents(precinct_refs.values(), field_paths=GRAPH_VOTER_FIELDS)
+    for (precinct, _), data in voters.items():
+        if precinct in precinct_refs:
+            add_precinct_location(data, precincts.get(precinct_refs[precinct].path, {}))
+    return voters
+
+
+async def get_survey_voter_async(survey):
+    # get_survey_voters for a single survey on async_db. The precinct is read
+    # together with the voter rather than after it, in case the voter needs
+    # its location.
+    precinct, voter_id = survey.get('precintList'), survey.get('userDocumentId')
+    if not precinct or not voter_id:
+        return None
+    precinct_ref = async_db.collection(VOTERS_COLLECTION).document(precinct)
+    voter_snapshot, precinct_snapshot = await asyncio.gather(
+        precinct_ref.collection('voters').document(voter_id).get(field_paths=GRAPH_VOTER_FIELDS),
+        precinct_ref.get(field_paths=GRAPH_VOTER_FIELDS),
+    )
+    if not voter_snapshot.exists:
+        return None
+    precinct_data = precinct_snapshot.to_dict() if precinct_snapshot.exists else {}
+    return add_precinct_location(voter_snapshot.to_dict(), precinct_data)
+
+
+def find_existing_precincts(precincts):
+    # Batched existence check, one get_all per PRECINCT_LOOKUP_CHUNK precincts,
+    # returns {precinct: total_voters} for the precincts already in Firestore
+    existing = {}
+    for start in range(0, len(precincts), PRECINCT_LOOKUP_CHUNK):
+        refs = [db.collection(VOTERS_COLLECTION).document(precinct) for precinct in precincts[start:start + PRECINCT_LOOKUP_CHUNK]]
+        for snapshot in db.get_all(refs, field_paths=["total_voters"]):
+            if snapshot.exists:
+                existing[snapshot.id] = snapshot.to_dict().get("total_voters") or 0
+    return existing
+
+
+class IngestionJob:
+    # Background load of one uploaded voter-list PDF into Firestore, in three
+    # phases: the PDF is parsed into the parse cache to learn its precincts,
+    # the precincts already in Firestore are looked up in one batched read,
+    # and the voters are written from the cache. The job state is saved under
+    # uploads/jobs after every phase and every committed batch so an
+    # interrupted job resumes where it left off without parsing or reading again.
+    FIELDS = [
+        "id", "filename", "file_path", "sha256", "mode", "status", "phase",
+        "created_at", "started_at", "finished_at", "pages_done", "page_count",
+        "precincts", "existing_precincts", "current_precinct", "precincts_done",
+        "precincts_skipped", "last_committed_precinct", "committed_items",
+        "voters_written", "voters_per_sec", "errors",
+    ]
+
+    def __init__(self, job_id, filename, file_path, sha256=None, mode="fail"):
+        self.id = job_id
+        self.filename = filename
+        self.file_path = file_path
+        self.sha256 = sha256
+        self.mode = mode
+        self.status = "queued"
+        self.phase = None
+        self.created_at = datetime.utcnow().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.pages_done = 0
+        self.page_count = None
+        # {precinct: total_voters} of the PDF, in order, and of the precincts already in Firestore
+        self.precincts = None
+        self.existing_precincts = None
+        self.current_precinct = None
+        self.precincts_done = 0
+        self.precincts_skipped = 0
+        self.last_committed_precinct = None
+        # Number of parser items (precinct headers and voters) already in Firestore
+        self.committed_items = 0
+        self.voters_written = 0
+        self.voters_per_sec = 0.0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        with self.lock:
+            return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        job = cls(data["id"], data["filename"], data["file_path"])
+        for field in cls.FIELDS:
+            if field in data:
+                setattr(job, field, data[field])
+        return job
+
+    def save(self):
+        path = os.path.join(INGEST_JOBS_DIR, f"{self.id}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(path + ".tmp", path)
+
+    def on_page(self, pages_done, page_count):
+        with self.lock:
+            self.pages_done = pages_done
+            self.page_count = page_count
+
+    def set_phase(self, phase):
+        with self.lock:
+            self.phase = phase
+        self.save()
+
+    def run(self):
+        with self.lock:
+            self.status = "running"
+            self.started_at = datetime.utcnow().isoformat()
+            self.finished_at = None
+        self.save()
+
+        try:
+            if self.precincts is None:
+                # Parsing fills the parse cache, the write phase replays it
+                self.set_phase("parsing")
+                precincts = {}
+                for precinct, voter in iter_voter_information_cached(self.file_path, self.sha256, on_page=self.on_page):
+                    precincts[precinct] = precincts.get(precinct, 0) + (voter is not None)
+                with self.lock:
+                    self.precincts = precincts
+
+            # Looked up once: on resume the precincts this job wrote itself must not count
+            if self.existing_precincts is None:
+                self.set_phase("checking")
+                existing = find_existing_precincts(list(self.precincts))
+                with self.lock:
+                    self.existing_precincts = existing
+
+            if self.existing_precincts and self.mode == "fail":
+                names = sorted(self.existing_precincts)
+                raise ValueError(f"Precinct '{names[0]}' already exists." if len(names) == 1 else f"{len(names)} precincts already exist: {', '.join(names[:10])}")
+
+            self.set_phase("writing")
+            self.write_voters()
+
+            with self.lock:
+                self.status = "completed"
+                self.phase = None
+                self.finished_at = datetime.utcnow().isoformat()
+
+        except Exception as e:
+            logging.error(f"Job {self.id} failed: {e}")
+            with self.lock:
+                self.status = "failed"
+                self.finished_at = datetime.utcnow().isoformat()
+                self.errors.append({"time": self.finished_at, "message": str(e)})
+
+        self.save()
+        clean_up_ingestion_jobs()
+
+    def write_voters(self):
+        started = time.monotonic()
+        voters_before_run = self.voters_written
+        resume_from = self.committed_items
+        existing = self.existing_precincts
+        skip_existing = self.mode == "skip-existing"
+        merge = self.mode == "merge"
+        writer = FirestoreBatchWriter(db)
+        # legacy_voter_ids of the existing precincts, for merge
+        legacy_ids = {}
+        voter_counts = {}
+        # Location of each precinct, taken from its first voter
+        locations = {}
+        finished_precincts = set()
+        current_precinct = None
+        voters_seen = 0
+        items = 0
+        precincts_written = False
+
+        def checkpoint(items_done):
+            nonlocal precincts_written
+            writer.commit()
+            # New precinct documents are visible now
+            if precincts_written:
+                precinct_ids.invalidate()
+                precincts_written = False
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.committed_items = items_done
+                self.voters_written = voters_seen
+                self.precincts_done = len(finished_precincts)
+                self.last_committed_precinct = current_precinct
+                if elapsed > 0:
+                    self.voters_per_sec = round((voters_seen - voters_before_run) / elapsed, 1)
+            self.save()
+
+        def finish_precinct(precinct, skip):
+            # The precinct document is written once its voters are, so a
+            # precinct document only exists for a completely loaded precinct
+            nonlocal precincts_written
+            finished_precincts.add(precinct)
+            if skip or (skip_existing and precinct in existing):
+                return
+            total = voter_counts[precinct]
+            if self.mode == "merge" and precinct in existing:
+                total = max(total, existing[precinct])
+            # updated_at tells /sync clients to download the voter list again
+            precinct_data = {"total_voters": total, "updated_at": datetime.utcnow().isoformat()}
+            if precinct in locations:
+                precinct_data.update(zip(LOCATION_FIELDS, locations[precinct]))
+            writer.set(db.collection(VOTERS_COLLECTION).document(precinct), precinct_data)
+            precincts_written = True
+
+        # Items before resume_from were committed by an earlier run: they are
+        # replayed to rebuild the counts, but not written again
+        for precinct, voter in iter_voter_information_cached(self.file_path, self.sha256, on_page=self.on_page):
+            items += 1
+            skip = items <= resume_from
+
+            # Keep all writes of one item in the same batch so checkpoints are exact
+            if not skip and writer.pending + 2 > writer.batch_size:
+                checkpoint(items - 1)
+
+            # Moving on to another precinct: store the total of the previous one
+            if current_precinct is not None and current_precinct != precinct:
+                finish_precinct(current_precinct, skip)
+            current_precinct = precinct
+
+            precinct_ref = db.collection(VOTERS_COLLECTION).document(precinct)
+
+            if voter is None:
+                self.current_precinct = precinct
+                voter_counts[precinct] = 0
+                if skip:
+                    continue
+                if precinct in existing:
+                    if skip_existing:
+                        logging.info(f"Skipping existing precinct: {precinct}")
+                        continue
+                    if self.mode == "replace":
+                        # Voters at positions this PDF has are overwritten, only the rest is deleted
+                        keep = {voter_document_id(precinct, number) for number in range(1, self.precincts[precinct] + 1)}
+                        for voter_ref in precinct_ref.collection('voters').list_documents():
+                            if voter_ref.id not in keep:
+                                writer.delete(voter_ref)
+                logging.info(f"Processing precinct: {precinct}")
+                continue
+
+            voter_counts[precinct] += 1
+            location = locations.setdefault(precinct, voter.location)
+            if skip_existing and precinct in existing:
+                continue
+            voters_seen += 1
+            if not skip:
+                # Add the voter to the voters sub-collection
+                document_id = voter_document_id(precinct, voter_counts[precinct])
+                if merge and precinct in existing:
+                    if precinct not in legacy_ids:
+                        legacy_ids[precinct] = legacy_voter_ids(precinct_ref, precinct)
+                    document_id = legacy_ids[precinct].get((voter.number, voter.name), document_id)
+                    voter_ref = precinct_ref.collection('voters').document(document_id)
+                    writer.set(voter_ref, merged_voter_document(voter, location), merge=True)
+                else:
+                    voter_ref = precinct_ref.collection('voters').document(document_id)
+                    writer.set(voter_ref, voter_document(voter, location))
+
+        if current_precinct is not None:
+            finish_precinct(current_precinct, items <= resume_from)
+        checkpoint(items)
+
+        with self.lock:
+            self.precincts_skipped = len(existing) if skip_existing else 0
+        logging.info(f"Job {self.id}: added {voters_seen} voters in {len(voter_counts)} precincts ({self.mode}), {writer.commits} commits, {writer.retries} retries, {self.voters_per_sec} voters/sec")
+
+
+# Background ingestion jobs, by job ID
+ingest_jobs = {}
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS)
+# Held while uploads are stored or deleted, so a clean-up never deletes the
+# upload of a job it has not seen yet
+ingest_uploads_lock = threading.Lock()
+
+
+def submit_ingestion_job(job):
+    ingest_jobs[job.id] = job
+    ingest_executor.submit(job.run)
+
+
+def get_ingestion_job(job_id):
+    from werkzeug.utils import secure_filename
+
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        path = os.path.join(INGEST_JOBS_DIR, f"{secure_filename(job_id)}.json")
+        if os.path.exists(path):
+            job = IngestionJob.load(path)
+            ingest_jobs[job.id] = job
+    return job
+
+
+def saved_ingestion_jobs():
+    # Every job in INGEST_JOBS_DIR, as it is in memory if it is loaded
+    jobs = []
+    for name in os.listdir(INGEST_JOBS_DIR):
+        if not name.endswith(".json"):
+            continue
+        job = ingest_jobs.get(name[:-len(".json")])
+        if job is None:
+            try:
+                job = IngestionJob.load(os.path.join(INGEST_JOBS_DIR, name))
+            except (OSError, ValueError) as e:
+                logging.warning(f"Skipping ingestion job file {name}: {e}")
+                continue
+        jobs.append(job)
+    return jobs
+
+
+def clean_up_ingestion_jobs():
+    # Deletes the files of the jobs finished more than INGEST_JOB_RETENTION_DAYS
+    # ago, and the uploads no job will read again. A completed job is done
+    # with its upload; a failed one keeps it until it expires, for
+    # /jobs/{id}/resume. Uploads of the same file are shared, see store_upload.
+    cutoff = (datetime.utcnow() - timedelta(days=INGEST_JOB_RETENTION_DAYS)).isoformat()
+    with ingest_uploads_lock:
+        needed, unneeded = set(), set()
+        for job in saved_ingestion_jobs():
+            with job.lock:
+                status, finished_at, file_path = job.status, job.finished_at, job.file_path
+            expired = status in ("completed", "failed") and finished_at is not None and finished_at < cutoff
+            if expired:
+                try:
+                    os.remove(os.path.join(INGEST_JOBS_DIR, f"{job.id}.json"))
+                except FileNotFoundError:
+                    pass
+                ingest_jobs.pop(job.id, None)
+            (unneeded if expired or status == "completed" else needed).add(file_path)
+        for file_path in unneeded - needed:
+            try:
+                os.remove(file_path)
+                logging.info(f"Deleted upload {file_path}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Error deleting upload {file_path}: {e}")
+
+
+@app.on_event("startup")
+def resume_ingestion_jobs():
+    clean_up_ingestion_jobs()
+    # Pick up jobs that were queued or running when the server went down
+    for job in saved_ingestion_jobs():
+        if job.status in ("queued", "running"):
+            logging.info(f"Resuming ingestion job {job.id} after {job.committed_items} committed items")
+            submit_ingestion_job(job)
+
+
+def store_upload(source, job_id, filename, mode):
+    # Copies an upload to uploads/<sha256>.pdf, hashing it on the way, and
+    # saves its job. Uploads of the same file share one copy. Blocking: the
+    # route runs it in the threadpool.
+    part_path = os.path.join('uploads', f"{job_id}.part")
+    digest = hashlib.sha256()
+    try:
+        with open(part_path, "wb") as buffer:
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                buffer.write(chunk)
+        sha256 = digest.hexdigest()
+        job = IngestionJob(job_id, filename, os.path.join('uploads', f"{sha256}.pdf"), sha256, mode)
+        with ingest_uploads_lock:
+            os.replace(part_path, job.file_path)
+            job.save()
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    return job
+
+
 @app.post("/addusers")
-async def create_users(file: UploadFile = File(...)):
+async def create_users(file: UploadFile = File(...), mode: str = "fail"):
+    from werkzeug.utils import secure_filename
+
+    if mode not in INGEST_MODES:
+        return JSONResponse(content={"error": f"mode must be one of {', '.join(INGEST_MODES)}"}, status_code=400)
+
     try:
         # Check for valid file type
         if not allowed_file(file.filename):
@@ -455,43 +1577,53 @@ async def create_users(file: UploadFile = File(...)):
         print("filename", file.filename)
         # Secure the filename and save the uploaded file
         filename = secure_filename(file.filename)
-        file_path = os.path.join('uploads', filename)
+        job_id = uuid.uuid4().hex
         
-        # Save the uploaded file locally
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
+        # Save the uploaded file locally, off the event loop
+        job = await run_in_threadpool(store_upload, file.file, job_id, filename, mode)
 
-        # Extract voter information from the uploaded PDF
-        voter_information = extract_voter_information_from_pdf(file_path)
+        # Parsing and the Firestore load run in the background
+        submit_ingestion_job(job)
 
-        # Iterate through each precinct and add to Firestore
-        for precinct, data in voter_information.items():
-            print(f"Processing precinct: {precinct}")
+        return JSONResponse(content={"message": "Upload accepted", "jobId": job_id}, status_code=202)
+    
+    except Exception as e:
+        print(f"Error: {e}")
+        raise HTTPException(status_code=500, detail="An error occurred while processing the file")
 
-            # Reference to the precinct document
-            precinct_ref = db.collection(VOTERS_COLLECTION).document(precinct)
-            precinct_doc = precinct_ref.get()
 
-            # Check if precinct document already exists
-            if precinct_doc.exists:
-                return JSONResponse(
-                    content={"error": f"Precinct '{precinct}' already exists."}, 
-                    status_code=400
-                )
+@app.get('/jobs/{job_id}')
+def get_job_status(job_id: str):
+    job = get_ingestion_job(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    # The path of the upload on the server stays out of the response
+    status = job.to_dict()
+    del status["file_path"]
+    return JSONResponse(content=status, status_code=200)
 
-            # Add new precinct and its voters
-            precinct_ref.set({"total_voters": data['total_voters']})
-            voters_ref = precinct_ref.collection('voters')
 
-            # Add each voter to the voters sub-collection
-            for voter in data["voters"]:
-                voters_ref.add(voter)
+@app.post('/jobs/{job_id}/resume')
+def resume_job(job_id: str, mode: Optional[str] = None):
+    job = get_ingestion_job(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+    if job.status != "failed":
+        return JSONResponse(content={"error": f"Job is {job.status}"}, status_code=409)
+    if mode is not None and mode not in INGEST_MODES:
+        return JSONResponse(content={"error": f"mode must be one of {', '.join(INGEST_MODES)}"}, status_code=400)
+    # The mode can only change while nothing has been written, e.g. to retry
+    # a "fail" upload with skip-existing without parsing or reading again
+    if mode is not None and mode != job.mode and job.committed_items:
+        return JSONResponse(content={"error": "The mode of a partly written job cannot change"}, status_code=409)
 
-        return JSONResponse(content={"message": "Data added successfully"}, status_code=201)
-    
-    except Exception as e:
-        print(f"Error: {e}")
-        raise HTTPException(status_code=500, detail="An error occurred while processing the file")
+    with job.lock:
+        if mode is not None:
+            job.mode = mode
+        job.status = "queued"
+    job.save()
+    submit_ingestion_job(job)
+    return JSONResponse(content={"message": "Job resumed", "jobId": job.id}, status_code=202)
 
 
 
@@ -520,6 +1652,7 @@ def addElection(data: ElectionData):
         'created_at':created_at,
         'isAllocated':False
     })
+    report_cache.invalidate("elections")
     logging.info(f"new_election_ref: {new_election_ref}")
     # Return success message
     return JSONResponse(content={"message": "Election Added successful"}, status_code=201)
@@ -528,11 +1661,11 @@ def addElection(data: ElectionData):
 
 
 @app.get('/allelection')
-def allelection():
+def allelection(page: PageParams = Depends()):
     try:
         # Fetch all documents from the collection
         users_ref = db.collection(ELECTION_COLLECTION)
-        docs = users_ref.stream()
+        docs = list(page.apply(users_ref).stream())
         logging.info(f"users_ref: {users_ref}")
 
         # Extract document data
@@ -542,7 +1675,7 @@ def allelection():
             election_data["id"] = doc.id    # Add document ID to the data
             all_elections.append(election_data)
 
-        return JSONResponse(content=all_elections, status_code=200)
+        return JSONResponse(content=all_elections, status_code=200, headers=page.headers(docs))
     
     except Exception as e:
         logging.error(f"Error: {e}")
@@ -558,7 +1691,7 @@ def get_userDetails(userid: str):
         if not user_doc.exists:
             raise HTTPException(status_code=404, detail="User not found")
 
-        user_data = user_doc.to_dict()
+        user_data = public_user(user_doc.to_dict())
         return user_data
      
     
@@ -567,14 +1700,11 @@ def get_userDetails(userid: str):
         return JSONResponse(content={"error": "Failed to retrieve users"}, status_code=500)
 def get_userName(userid: str):
     try:
-        users_ref = db.collection(USERS_COLLECTION).document(userid)
-        user_doc = users_ref.get()  # Fetch the document
+        user_data = user_profiles.get(userid)
 
-        if not user_doc.exists:
+        if user_data is None:
             raise HTTPException(status_code=404, detail="User not found")
 
-        # Convert document data to a dictionary
-        user_data = user_doc.to_dict()
         return user_data['username']
      
     
@@ -612,7 +1742,9 @@ def get_surveyor():
 def get_allocation_list():
     try:
         users_ref = db.collection(ALLOCATE_COLLECTION)  
-        docs = users_ref.stream()
+        docs = list(users_ref.stream())
+        # Fetch all surveyor names at once
+        user_profiles.get_many(doc.to_dict().get('surveyorId') for doc in docs)
 
         users = []
         for doc in docs:
@@ -702,10 +1834,10 @@ def get_candidate():
         return JSONResponse(content={"error": "Failed to retrieve users"}, status_code=500)
 
 @app.get('/get_allocated_list')
-def get_allocated_list():
+def get_allocated_list(page: PageParams = Depends()):
     try:
         users_ref = db.collection(ALLOCATE_COLLECTION)
-        docs = users_ref.stream()
+        docs = list(page.apply(users_ref).stream())
 
         users = []
         for doc in docs:
@@ -714,7 +1846,7 @@ def get_allocated_list():
             users.append(user_data)
           
 
-        return JSONResponse(content=users, status_code=200)
+        return JSONResponse(content=users, status_code=200, headers=page.headers(docs))
     except Exception as e:
         print(f"Error: {e}")
         return JSONResponse(content={"error": "Failed to retrieve users"}, status_code=500)
@@ -742,16 +1874,18 @@ def verifierCheck(verifierId: str, documentId: str):
         return JSONResponse(content={"error": "Failed to update the document"}, status_code=500)
 
 
-def getElectionDetails(electionId):
+async def getElectionDetails(electionId):
     try:
-        # Query documents where electionId matches the given electionId
-        docs = db.collection(ELECTION_COLLECTION).where('electionId', '==', electionId).stream()
-        
         # List to store election details
         election_details = []
 
-        for doc in docs:
-            election_details.append(doc.to_dict())  # Convert each document to a dictionary and add to the list
+        if election_replica.ready():
+            election_details = election_replica.lookup(electionId=electionId)
+        else:
+            # Query documents where electionId matches the given electionId
+            docs = async_db.collection(ELECTION_COLLECTION).where('electionId', '==', electionId).stream()
+            async for doc in docs:
+                election_details.append(doc.to_dict())  # Convert each document to a dictionary and add to the list
 
         # Return the election details or None if not found
         return election_details if election_details else None
@@ -760,13 +1894,12 @@ def getElectionDetails(electionId):
         return None  # Return None in case of an error
 def getVerifierName(verifierId):
     try:
-        # Get the document by verifierId
-        doc_ref = db.collection(USERS_COLLECTION).document(verifierId)  # Use the correct reference
-        doc = doc_ref.get()  # Call get() on the document reference
+        # Get the profile by verifierId
+        profile = user_profiles.get(verifierId)
         
         # Check if the document exists
-        if doc.exists:
-            return doc.to_dict().get('username')  # Return the 'username' field of the document
+        if profile is not None:
+            return profile.get('username')  # Return the 'username' field of the document
         else:
             return None  # Document not found
     except Exception as e:
@@ -776,21 +1909,32 @@ def getVerifierName(verifierId):
 
 
 @app.get('/getVerifiedSurveyDetails/{surveyorId}/')
-def getVerifiedSurveyDetails(surveyorId: str):
+async def getVerifiedSurveyDetails(surveyorId: str):
     try:
-        docs = db.collection(ALLOCATE_COLLECTION).where('isOpen', '==', True).where('surveyorId', '==', surveyorId).stream()
+        if allocate_replica.ready():
+            docs = allocate_replica.lookup(isOpen=True, surveyorId=surveyorId)
+        else:
+            query = async_db.collection(ALLOCATE_COLLECTION).where('isOpen', '==', True).where('surveyorId', '==', surveyorId)
+            docs = [doc.to_dict() async for doc in query.stream()]
+
+        # Look up every election and the verifier names at the same time
+        election_ids = list(dict.fromkeys(doc_data.get('electionId') for doc_data in docs))
+        elections, profiles = await asyncio.gather(
+            gather_limited(getElectionDetails(electionId) for electionId in election_ids),
+            user_profiles.get_many_async(doc_data.get('verifierId') for doc_data in docs),
+        )
+        elections = dict(zip(election_ids, elections))
 
         # List to store the details of documents
         open_documents = []
 
-        for doc in docs:
-            doc_data = doc.to_dict()  # Convert document to dictionary
+        for doc_data in docs:
             electionId = doc_data.get('electionId')
             verifierId = doc_data.get('verifierId')
 
             # Retrieve election details
-            election_details = getElectionDetails(electionId) or {}
-            verifier_name = getVerifierName(verifierId) or "Unknown Verifier"
+            election_details = elections[electionId] or {}
+            verifier_name = get_username(verifierId, profiles, None) or "Unknown Verifier"
 
             # Combine the document data with election details and verifier name
             combined_data = {
@@ -810,15 +1954,173 @@ def getVerifiedSurveyDetails(surveyorId: str):
         print(f"Error: {e}")
         return JSONResponse(content={"error": "Failed to retrieve documents"}, status_code=500)
 
+# Vote tallies. The summary holds
+#   candidates       {candidateId: votes}
+#   weeks            {week: {candidateId: votes}}, week is the Monday as YYYY-MM-DD
+#   week_precincts   {week: {candidateId: precinct of the latest survey}}
+# and SurveyGraphTallies has one document per candidate, election, province,
+# city and precinct with the votes and the age and gender buckets. Each
+# survey adds to them in the same batch that writes it, and a rebuild
+# recomputes them from all the surveys with an analytics.SurveyFrame. The
+# dashboard endpoints only read them, and answer 503 until the first
+# POST /surveyTallies/rebuild: a rebuild overwrites the tallies, so it only
+# runs when asked for, never in the middle of a read.
+#
+# Every survey updates the summary, and Firestore sustains about one write
+# per second to a document, so the summary is split over SURVEY_TALLY_SHARDS
+# documents of SurveyTallies: summary, summary_1, summary_2, ... A survey
+# increments one of them at random and reads add them all up. The shards
+# also keep week_precinct_times, {week: {candidateId: created_at}}, to tell
+# which of them has the latest survey of a week.
+survey_tallies_lock = threading.Lock()
+
+
+class SurveyTalliesNotBuilt(Exception):
+    pass
+
+
+def tallies_not_built_response():
+    return JSONResponse(content={"error": "Survey tallies have not been built yet, POST /surveyTallies/rebuild first"}, status_code=503)
+
+
+def as_increments(update):
+    from google.cloud.firestore import Increment
+
+    return {
+        key: as_increments(value) if isinstance(value, dict) else Increment(value) if isinstance(value, int) else value
+        for key, value in update.items()
+    }
+
+
+def summary_shard(client):
+    shard = random.randrange(SURVEY_TALLY_SHARDS)
+    return client.collection(SURVEY_TALLIES_COLLECTION).document("summary" if shard == 0 else f"summary_{shard}")
+
+
+def summary_shard_update(survey_data, voter):
+    # survey_tally_updates with the times of its week_precincts, and the
+    # graph document ID and update
+    summary, graph_id, graph = survey_tally_updates(survey_data, voter)
+    created_at = str(survey_data.get('created_at'))
+    summary["week_precinct_times"] = {
+        week: {candidate: created_at for candidate in precincts}
+        for week, precincts in summary.get("week_precincts", {}).items()
+    }
+    return summary, graph_id, graph
+
+
+def merge_summary_shards(shards):
+    # The summary tallies of the shard documents: the counts add up and a
+    # week's precinct comes from the shard with its latest survey. A rebuilt
+    # summary has no times; whatever was added since is later.
+    summary = {"candidates": {}, "weeks": {}, "week_precincts": {}}
+    latest = {}
+    for shard in shards:
+        add_tally(summary["candidates"], shard.get("candidates", {}))
+        add_tally(summary["weeks"], shard.get("weeks", {}))
+        times = shard.get("week_precinct_times", {})
+        for week, precincts in shard.get("week_precincts", {}).items():
+            for candidate, precinct in precincts.items():
+                created_at = times.get(week, {}).get(candidate, "")
+                if (week, candidate) not in latest or created_at > latest[week, candidate]:
+                    latest[week, candidate] = created_at
+                    summary["week_precincts"].setdefault(week, {})[candidate] = precinct
+    return summary
+
+
+def read_summary_shards():
+    # {document ID: data} of the summary shards
+    shards = {doc.id: doc.to_dict() for doc in db.collection(SURVEY_TALLIES_COLLECTION).stream()}
+    return shards
+
+
+def add_survey_to_batch(client, batch, survey_data, voter):
+    # The survey and its tally updates go into the same batch
+    summary, graph_id, graph = summary_shard_update(survey_data, voter)
+    batch.set(client.collection(SURVEY_COLLECTION).document(), survey_data)
+    batch.set(summary_shard(client), as_increments(summary), merge=True)
+    if graph is not None:
+        batch.set(client.collection(SURVEY_GRAPH_TALLIES_COLLECTION).document(graph_id), as_increments(graph), merge=True)
+
+
+def rebuild_survey_tallies(dry_run=False):
+    # Recompute the tallies from the Survey collection. Returns the summary,
+    # the number of graph documents and the keys that differed from the
+    # stored tallies. A survey added while this runs can be missed: rebuild
+    # when no surveys come in.
+    surveys = [survey.to_dict() for survey in db.collection(SURVEY_COLLECTION).stream()]
+    frame = SurveyFrame(surveys, get_survey_voters(surveys))
+    summary = frame.summary_tallies()
+    graphs = frame.graph_tallies()
+
+    stored_shards = read_summary_shards()
+    stored = merge_summary_shards(stored_shards.values())
+    stored_graphs = {doc.id: doc.to_dict() for doc in db.collection(SURVEY_GRAPH_TALLIES_COLLECTION).stream()}
+    mismatches = [field for field in summary if stored.get(field, {}) != summary[field]]
+    mismatches += [f"graph/{graph_id}" for graph_id in sorted(set(graphs) | set(stored_graphs)) if graphs.get(graph_id) != stored_graphs.get(graph_id)]
+
+    if not dry_run:
+        writer = FirestoreBatchWriter(db)
+        # The rebuilt summary goes into the first shard, the others start over
+        writer.set(db.collection(SURVEY_TALLIES_COLLECTION).document("summary"), {**summary, "rebuilt_at": datetime.utcnow().isoformat()})
+        for shard_id in stored_shards.keys() - {"summary"}:
+            writer.delete(db.collection(SURVEY_TALLIES_COLLECTION).document(shard_id))
+        for graph_id in stored_graphs.keys() - graphs.keys():
+            writer.delete(db.collection(SURVEY_GRAPH_TALLIES_COLLECTION).document(graph_id))
+        for graph_id, graph in graphs.items():
+            writer.set(db.collection(SURVEY_GRAPH_TALLIES_COLLECTION).document(graph_id), graph)
+        writer.commit()
+        logging.info(f"Rebuilt survey tallies from {len(surveys)} surveys, {len(graphs)} graph documents, {len(mismatches)} mismatches")
+    return summary, len(graphs), mismatches
+
+
+def get_survey_tallies():
+    # The summary tallies. Until the first rebuild they only hold the surveys
+    # added since the deploy, so they are not served: SurveyTalliesNotBuilt.
+    shards = read_summary_shards()
+    if "rebuilt_at" not in shards.get("summary", {}):
+        raise SurveyTalliesNotBuilt()
+    return merge_summary_shards(shards.values())
+
+
+def get_graph_tallies():
+    get_survey_tallies()
+    return [doc.to_dict() for doc in db.collection(SURVEY_GRAPH_TALLIES_COLLECTION).stream()]
+
+
+@app.post('/surveyTallies/rebuild')
+def rebuild_tallies(dry_run: bool = False):
+    try:
+        with survey_tallies_lock:
+            summary, graph_count, mismatches = rebuild_survey_tallies(dry_run)
+        if not dry_run:
+            report_cache.invalidate("surveys")
+        return JSONResponse(content={
+            "dryRun": dry_run,
+            "candidates": len(summary["candidates"]),
+            "weeks": len(summary["weeks"]),
+            "graphDocuments": graph_count,
+            "mismatches": mismatches[:100],
+            "mismatchCount": len(mismatches),
+        }, status_code=200)
+    except Exception as e:
+        logging.error(f"Error rebuilding survey tallies: {e}")
+        return JSONResponse(content={"error": "Failed to rebuild survey tallies"}, status_code=500)
+
+
 @app.post("/surveys/")
 async def create_survey(survey: SurveyDetails):
     # Prepare the data to be added to Firestore
     survey_data = survey.dict()
     survey_data['created_at'] = datetime.utcnow().isoformat()  # Add created_at timestamp
 
-    # Add the survey data to the Firestore collection
+    # Add the survey data to the Firestore collection, with its tallies
     try:
-        db.collection(SURVEY_COLLECTION).add(survey_data)
+        voter = await get_survey_voter_async(survey_data)
+        batch = async_db.batch()
+        add_survey_to_batch(async_db, batch, survey_data, voter)
+        await batch.commit()
+        report_cache.invalidate("surveys")
         return JSONResponse(content={"message": "Survey created successfully"}, status_code=201)
     except Exception as e:
         # Include the exception message and code in the response
@@ -828,28 +2130,152 @@ async def create_survey(survey: SurveyDetails):
         )
 
 
+def survey_document_id(surveyor_id, idempotency_key):
+    return hashlib.sha1(f"{surveyor_id}/{idempotency_key}".encode()).hexdigest()[:20]
+
+
+def write_survey_chunk(chunk, voters):
+    # Creates the surveys of chunk, [(document ID, survey data)], with their
+    # tally increments summed into one update per tally document
+    summary = {}
+    graphs = {}
+    for _, survey_data in chunk:
+        voter = voters.get((survey_data.get('precintList'), survey_data.get('userDocumentId')))
+        summary_update, graph_id, graph = summary_shard_update(survey_data, voter)
+        add_tally(summary, summary_update)
+        if graph is not None:
+            add_tally(graphs.setdefault(graph_id, {}), graph)
+
+    writer = FirestoreBatchWriter(db)
+    for survey_id, survey_data in chunk:
+        writer.create(db.collection(SURVEY_COLLECTION).document(survey_id), survey_data)
+    writer.set(summary_shard(db), as_increments(summary), merge=True)
+    for graph_id, graph in graphs.items():
+        writer.set(db.collection(SURVEY_GRAPH_TALLIES_COLLECTION).document(graph_id), as_increments(graph), merge=True)
+    writer.commit()
+
+
+def survey_chunks(surveys, voters):
+    # Splits [(document ID, survey data)] so the surveys of a chunk and their
+    # tally documents fit in one batch
+    chunk = []
+    graph_ids = set()
+    for survey_id, survey_data in surveys:
+        voter = voters.get((survey_data.get('precintList'), survey_data.get('userDocumentId')))
+        _, graph_id, _ = survey_tally_updates(survey_data, voter)
+        new_graph_ids = graph_ids | {graph_id} if graph_id is not None else graph_ids
+        if chunk and len(chunk) + 1 + 1 + len(new_graph_ids) > MAX_BATCH_WRITES:
+            yield chunk
+            chunk = []
+            new_graph_ids = {graph_id} if graph_id is not None else set()
+        chunk.append((survey_id, survey_data))
+        graph_ids = new_graph_ids
+    if chunk:
+        yield chunk
+
+
+@app.post("/surveys/batch")
+def create_surveys_batch(items: List[dict] = Body(...)):
+    # Surveys recorded offline, sent together. Every item is a survey plus
+    # its idempotencyKey; an item whose key was already stored (by an earlier
+    # attempt, or earlier in the same request) is reported as a duplicate and
+    # not counted again. Returns one result per item, in order.
+    from google.api_core.exceptions import Conflict
+
+    if len(items) > MAX_SURVEY_BATCH:
+        return JSONResponse(content={"error": f"At most {MAX_SURVEY_BATCH} surveys per batch"}, status_code=413)
+
+    results = [None] * len(items)
+    surveys = {}  # document ID -> (index, survey data)
+    started = datetime.utcnow()
+    for index, item in enumerate(items):
+        try:
+            survey = SurveyBatchItem(**item)
+        except (ValidationError, TypeError) as e:
+            errors = [{"loc": list(error["loc"]), "msg": error["msg"]} for error in e.errors()] if isinstance(e, ValidationError) else [{"msg": str(e)}]
+            results[index] = {"index": index, "status": "invalid", "errors": errors}
+            continue
+        survey_id = survey_document_id(survey.surveyorId, survey.idempotencyKey)
+        if survey_id in surveys:
+            results[index] = {"index": index, "idempotencyKey": survey.idempotencyKey, "status": "duplicate", "id": survey_id}
+            continue
+        survey_data = survey.dict()
+        # One microsecond apart, so a tally rebuild orders them as sent
+        survey_data['created_at'] = (started + timedelta(microseconds=index)).isoformat()
+        surveys[survey_id] = (index, survey_data)
+
+    def result(survey_id, status, **extra):
+        index, survey_data = surveys[survey_id]
+        results[index] = {"index": index, "idempotencyKey": survey_data['idempotencyKey'], "status": status, "id": survey_id, **extra}
+
+    def stored(survey_ids):
+        refs = [db.collection(SURVEY_COLLECTION).document(survey_id) for survey_id in survey_ids]
+        return {path.rsplit("/", 1)[-1] for path in get_all_documents(refs, field_paths=["idempotencyKey"])}
+
+    try:
+        # Already stored by an earlier attempt
+        for survey_id in stored(surveys):
+            result(survey_id, "duplicate")
+        pending = [(survey_id, survey_data) for survey_id, (_, survey_data) in surveys.items() if results[surveys[survey_id][0]] is None]
+        voters = get_survey_voters([survey_data for _, survey_data in pending])
+    except Exception as e:
+        logging.error(f"Error preparing survey batch: {e}")
+        return JSONResponse(content={"error": "Failed to store the surveys"}, status_code=500)
+
+    created = 0
+    for chunk in survey_chunks(pending, voters):
+        # A concurrent retry of the same surveys makes the whole batch fail
+        # with AlreadyExists: take out the surveys it stored and try again
+        for attempt in range(3):
+            try:
+                if chunk:
+                    write_survey_chunk(chunk, voters)
+                for survey_id, _ in chunk:
+                    result(survey_id, "created")
+                created += len(chunk)
+                break
+            except Conflict:
+                existing = stored(survey_id for survey_id, _ in chunk)
+                for survey_id in existing:
+                    result(survey_id, "duplicate")
+                chunk = [(survey_id, survey_data) for survey_id, survey_data in chunk if survey_id not in existing]
+            except Exception as e:
+                logging.error(f"Error writing survey batch: {e}")
+                for survey_id, _ in chunk:
+                    result(survey_id, "failed", error=str(e))
+                break
+        else:
+            for survey_id, _ in chunk:
+                result(survey_id, "failed", error="Conflicting writes")
+
+    if created:
+        report_cache.invalidate("surveys")
+    counts = {status: sum(1 for item in results if item["status"] == status) for status in ("created", "duplicate", "invalid", "failed")}
+    return JSONResponse(content={**counts, "results": results}, status_code=200)
+
+
 logging.basicConfig(level=logging.INFO)
 
 @app.get('/surveys/{surveyorId}/{electionId}/{precintNo}/')
-def getSurveyById(surveyorId: str,electionId: str,precintNo: str):
+def getSurveyById(surveyorId: str,electionId: str,precintNo: str, request: Request, stream: bool = False):
     try:
         # Check if surveyorId is valid
         if not surveyorId:
             raise HTTPException(status_code=400, detail="Invalid surveyor ID.")
 
-        # Fetch documents from Firestore using keyword arguments
-        docs = db.collection(SURVEY_COLLECTION).where('surveyorId', '==', surveyorId).where('electionId', '==', electionId).where('precintList', '==', precintNo).stream()
+        # Fetch documents from the replica, or from Firestore
+        docs = survey_replica.find(surveyorId=surveyorId, electionId=electionId, precintList=precintNo)
+
+        # created_at timestamps are encoded as ISO strings by JSONResponse
+        if wants_ndjson(request, stream):
+            rows = iter(docs)
+            first = next(rows, None)
+            if first is None:
+                raise HTTPException(status_code=404, detail="No surveys found for this surveyor ID.")
+            return ndjson_response(itertools.chain([first], rows))
 
         # Convert documents to a list of dictionaries
-        survey_data = []
-        for doc in docs:
-            doc_dict = doc.to_dict()
-            print(doc_dict)
-            if 'created_at' in doc_dict:
-                created_at = doc_dict['created_at']
-                print(created_at)
-            doc_dict['created_at'] = created_at.isoformat()
-            survey_data.append(doc_dict)
+        survey_data = list(docs)
 
         if not survey_data:
             # If no surveys found, return 404
@@ -870,13 +2296,12 @@ def getexcludeUserId(surveyorId: str,electionId: str,precintNo: str):
         if not surveyorId:
             raise HTTPException(status_code=400, detail="Invalid surveyor ID.")
 
-        # Fetch documents from Firestore using keyword arguments
-        docs = db.collection(SURVEY_COLLECTION).where('surveyorId', '==', surveyorId).where('electionId', '==', electionId).where('precintList', '==', precintNo).stream()
+        # Fetch documents from the replica, or from Firestore
+        docs = survey_replica.find(surveyorId=surveyorId, electionId=electionId, precintList=precintNo)
 
         # Convert documents to a list of dictionaries
         excluded_list = []
-        for doc in docs:
-            doc_dict = doc.to_dict()
+        for doc_dict in docs:
             excluded_list.append(doc_dict['userDocumentId'])
 
         if not excluded_list:
@@ -891,25 +2316,106 @@ def getexcludeUserId(surveyorId: str,electionId: str,precintNo: str):
         return JSONResponse(content={"error": str(e)}, status_code=500)
     
     
+def find_survey_voters(surveyorId, electionId, precinct, since=None):
+    # {survey document ID: voter document ID} of the surveys of one surveyor,
+    # election and precinct, only those added after since when given
+    filters = {"surveyorId": surveyorId, "electionId": electionId, "precintList": precinct}
+    from google.api_core.exceptions import FailedPrecondition
+
+    if survey_replica.ready():
+        items = survey_replica.lookup_items(**filters)
+    else:
+        query = db.collection(SURVEY_COLLECTION)
+        for field, value in filters.items():
+            query = query.where(field, '==', value)
+        query = query.select(['userDocumentId', 'created_at'])
+        try:
+            ranged = query.where('created_at', '>', since) if since is not None else query
+            items = [(doc.id, doc.to_dict()) for doc in ranged.stream()]
+        except FailedPrecondition as e:
+            # The range needs a composite index on surveyorId, electionId,
+            # precintList and created_at
+            logging.warning(f"Survey sync query without the created_at range: {e}")
+            items = [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    return {
+        survey_id: data.get('userDocumentId')
+        for survey_id, data in items
+        if since is None or (isinstance(data.get('created_at'), str) and data['created_at'] > since)
+    }
+
+
+@app.get('/sync/{precinct_id}')
+def sync_precinct(precinct_id: str, surveyorId: str, electionId: str, since: Optional[str] = None):
+    # Delta sync for the surveyor apps, in place of /users/{doc_id}/voters and
+    # /excludeUserId. Pass the watermark of the previous response as since.
+    #   full         true when voters is the whole list: no since, or the
+    #                precinct was loaded again since then
+    #   voters       the voters (all, or changed since since), in ID order
+    #   surveyIds    surveys added since since (all when full)
+    #   excluded     when full, base64 bitset of the surveyed voters: bit i
+    #                (byte i // 8, bit i % 8 from the lowest) is voters[i]
+    #   excludedIds  surveyed voters not in the bitset: when not full, the
+    #                ones surveyed since since
+    try:
+        if since is not None:
+            try:
+                datetime.fromisoformat(since)
+            except ValueError:
+                return JSONResponse(content={"error": "Invalid since watermark"}, status_code=400)
+        watermark = (datetime.utcnow() - timedelta(seconds=SYNC_WATERMARK_SLACK)).isoformat()
+
+        precinct_ref = db.collection(VOTERS_COLLECTION).document(precinct_id)
+        precinct_doc = precinct_ref.get()
+        if not precinct_doc.exists:
+            return JSONResponse(content={"error": "Precinct not found"}, status_code=404)
+        precinct_data = precinct_doc.to_dict()
+
+        full = since is None or precinct_data.get("updated_at", "") > since
+        voters_ref = precinct_ref.collection('voters')
+        if full:
+            docs = list(voters_ref.order_by("__name__").stream())
+        else:
+            docs = sorted(voters_ref.where('updated_at', '>', since).stream(), key=lambda doc: doc.id)
+
+        surveys = find_survey_voters(surveyorId, electionId, precinct_id, None if full else since)
+        excluded = {voter_id for voter_id in surveys.values() if voter_id}
+        response = {
+            "watermark": watermark,
+            "full": full,
+            "voters": [voter_row(doc, precinct_data) for doc in docs],
+            "surveyIds": sorted(surveys),
+        }
+        if full:
+            bits = bytearray((len(docs) + 7) // 8)
+            for position, doc in enumerate(docs):
+                if doc.id in excluded:
+                    bits[position >> 3] |= 1 << (position & 7)
+                    excluded.discard(doc.id)
+            response["excluded"] = base64.b64encode(bits).decode()
+        response["excludedIds"] = sorted(excluded)
+        return JSONResponse(content=response, status_code=200)
+
+    except Exception as e:
+        logging.error(f"Error syncing precinct {precinct_id}: {e}")
+        return JSONResponse(content={"error": "Failed to sync precinct"}, status_code=500)
+
+
 #get the updated details
  
 @app.get('/surveyData/{userDocumentId}')
 def surveyData(userDocumentId: str):
     try:
-        docs = db.collection(SURVEY_COLLECTION).where('userDocumentId', '==', userDocumentId).stream()
+        docs = list(survey_replica.find(userDocumentId=userDocumentId))
+        # Fetch all candidate names at once
+        user_profiles.get_many(doc_dict.get('candidateId') for doc_dict in docs)
         excluded_list = []
         
-        for doc in docs:
-            doc_dict = doc.to_dict()  # Convert each document to a dictionary
-            
-            # Check if 'created_at' is in the document
+        for doc_dict in docs:
+            # Check if 'created_at' is in the document (JSONResponse encodes
+            # it as an ISO string, whether it is a timestamp or already a string)
             if 'created_at' in doc_dict:
-                created_at = doc_dict['created_at']
                 username = get_userName(doc_dict['candidateId'])
-                
-                # Format the datetime to a readable string
-                formatted_datetime = created_at.strftime('%Y-%m-%d %H:%M:%S.%f %Z')
-                doc_dict['created_at'] = formatted_datetime  # Update the dictionary with the formatted datetime
                 doc_dict['candidate_name'] = username  # Add username to the dictionary
             
             excluded_list.append(doc_dict)  # Append the document to the list
@@ -926,57 +2432,27 @@ def surveyData(userDocumentId: str):
 from datetime import datetime
 from datetime import datetime, timedelta
 from collections import defaultdict
-from dateutil import parser
 @app.get('/surveyElectionData')
-async def surveyElectionData():
+@report_cache.cached(*REPORT_TAGS)
+def surveyElectionData(request: Request):
     try:
-        # Get all documents in the collection
-        docs = db.collection(SURVEY_COLLECTION).stream()
-        
-        # Convert documents to a list of dictionaries with formatted datetime
-        survey_data = []
-        for doc in docs:
-            doc_dict = doc.to_dict()
-            if 'created_at' in doc_dict and isinstance(doc_dict['created_at'], datetime):
-                formatted_datetime = doc_dict['created_at'].strftime('%Y-%m-%d %H:%M:%S.%f %Z')
-                doc_dict['created_at'] = formatted_datetime
-            survey_data.append(doc_dict)
-
-        # Calculate candidate vote counts
-        candidate_votes = defaultdict(int)
-        for entry in survey_data:
-            candidate_votes[entry['candidateId']] += 1
-
-        # Calculate weekly votes
-        weekly_votes = defaultdict(lambda: defaultdict(int))
-        for entry in survey_data:
-            created_at_str = entry['created_at']
-            
-            # Clean the string to handle different formats
-            if 'UTC' in created_at_str:
-                created_at_str = created_at_str.replace(' UTC', '')  # Remove ' UTC'
-            created_at = parser.isoparse(created_at_str)
-
-            week_start = created_at - timedelta(days=created_at.weekday())  # Get start of the week
-            week_end = week_start + timedelta(days=6)  # Calculate end of the week
-            week_str = week_start.strftime('%Y-%m-%d')
-            candidate_id = entry['candidateId']
-
-            # Increment the count for the specific candidate in that week
-            weekly_votes[week_str][candidate_id] += 1
-       
+        # Vote counts come from the survey tallies instead of a Survey scan
+        summary = get_survey_tallies()
+        candidate_votes = summary.get("candidates", {})
+        weekly_votes = summary.get("weeks", {})
+        # Fetch all candidate names at once
+        user_profiles.get_many(candidate_votes)
+
         # Format results for weekly votes
         weekly_votes_list = [
             {
-                "week_start": week_start.strftime('%Y-%m-%d'),
-                "week_end": week_end.strftime('%Y-%m-%d'),
+                "week_start": week_str,
+                "week_end": (datetime.fromisoformat(week_str) + timedelta(days=6)).strftime('%Y-%m-%d'),
                 "candidates": [
                     {"candidateId": candidate, "votes": count,"username": get_userName(candidate)} for candidate, count in candidates.items()
                 ]
             }
-            for week_str, candidates in weekly_votes.items()
-            for week_start in [parser.isoparse(week_str)]  # Convert week_str back to datetime
-            for week_end in [week_start + timedelta(days=6)]  # Calculate week end
+            for week_str, candidates in sorted(weekly_votes.items())
         ]
        
         # Format results for candidate votes
@@ -989,6 +2465,8 @@ async def surveyElectionData():
             "weekly_votes": weekly_votes_list
         }, status_code=200)
     
+    except SurveyTalliesNotBuilt:
+        return tallies_not_built_response()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1003,7 +2481,7 @@ def get_assistantDetails(userid: str):
         user_id = None
         for user_doc in users_ref:
             if user_doc.exists:
-                user_data = user_doc.to_dict()
+                user_data = public_user(user_doc.to_dict())
                 user_id = user_doc.id  # Get document ID
                 break  # Exit after finding the first match
 
@@ -1025,6 +2503,8 @@ def get_assistantDetails(userid: str, status: str):
 
         # Update the document by adding or updating the 'status' field
         user_ref.update({'status': status})
+        user_profiles.invalidate(userid)
+        report_cache.invalidate("users")
 
         # Retrieve the updated user document
         updated_user = user_ref.get().to_dict()
@@ -1039,70 +2519,35 @@ def get_assistantDetails(userid: str, status: str):
     
 
 @app.get('/getGraphDetails/')
-def getGraphDetails():
+@report_cache.cached(*REPORT_TAGS)
+def getGraphDetails(request: Request):
     try:
-        # Fetch all documents from the SURVEY_COLLECTION
-        survey_ref = db.collection(SURVEY_COLLECTION).stream()
-        survey_data = []
-        
-        # Loop through each document in the collection
-        for survey in survey_ref:
-            survey_dict = survey.to_dict()
-            
-            # Extract necessary information
-            userdocumentId = survey_dict.get('userDocumentId')
-            candidateId = survey_dict.get('candidateId')
-            electionId = survey_dict.get('electionId')
-            precintList = survey_dict.get('precintList')
-            
-            # Fetch voter data
-            voter_ref = db.collection(VOTERS_COLLECTION).document(precintList).collection('voters').document(userdocumentId)
-            voter_snapshot = voter_ref.get()
-            
-            if voter_snapshot.exists:
-                voter_data = voter_snapshot.to_dict()
-                
-                # Append data including voting information
-                survey_data.append({
-                    "userdocumentId": userdocumentId,
-                    "candidateId": candidateId,
-                    "electionId": electionId,
-                    "voterData": voter_data
-                })
-
-        # Transform data for Power BI
-        transformed_data = {}
-        
-        for entry in survey_data:
-            # Fetch candidate username
-            candidate_ref = db.collection(USERS_COLLECTION).document(entry["candidateId"]).get()
-            candidate_username = candidate_ref.to_dict().get("username", "Unknown") if candidate_ref.exists else "Unknown"
-
-            # Use candidateId, electionId, Province, City, and precintList to create a unique key
-            key = (entry["candidateId"], entry["electionId"], entry["voterData"]["Province"], entry["voterData"]["City"], precintList)
-            if key not in transformed_data:
-                transformed_data[key] = {
-                    "vote_count": 0,
-                    "candidate_username": candidate_username
-                }
-            transformed_data[key]["vote_count"] += 1  # Count votes
+        # Votes per candidate, election, province, city and precinct come from
+        # the survey tallies instead of a Survey scan
+        tallies = get_graph_tallies()
+        # Fetch all candidate names at once
+        candidates = user_profiles.get_many(tally["candidateId"] for tally in tallies)
 
         # Prepare the final response
         final_response = []
-        for (candidateId, electionId, province, city, precintList), data in transformed_data.items():
+        for tally in tallies:
             final_response.append({
-                "candidateId": candidateId,
-                "electionId": electionId,
-                "Province": province,
-                "City": city,
-                "VoteCount": data["vote_count"],
-                "CandidateUsername": data["candidate_username"],
-                "PrecintList": precintList
+                "candidateId": tally["candidateId"],
+                "electionId": tally["electionId"],
+                "Province": tally["Province"],
+                "City": tally["City"],
+                "VoteCount": tally["votes"],
+                "CandidateUsername": get_username(tally["candidateId"], candidates),
+                "PrecintList": tally["precintList"]
             })
 
+        round_trips = request_firestore_calls()
+        logging.info(f"getGraphDetails: {len(tallies)} tallies, {round_trips} Firestore round trips")
         # Return the transformed data
-        return JSONResponse(content=final_response)
+        return JSONResponse(content=final_response, headers={"X-Firestore-Round-Trips": str(round_trips)})
 
+    except SurveyTalliesNotBuilt:
+        return tallies_not_built_response()
     except Exception as e:
         logging.error(f"Error retrieving surveyor details: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving surveyor details")
@@ -1110,95 +2555,38 @@ def getGraphDetails():
 
 from datetime import datetime, timedelta
 from collections import defaultdict
-from fastapi.responses import JSONResponse
 from fastapi import HTTPException
-from google.cloud.firestore import DocumentSnapshot
 
 @app.get('/getWeeklyReportprecint/')
-def getWeeklyReportprecint():
+@report_cache.cached(*REPORT_TAGS)
+def getWeeklyReportprecint(request: Request):
     try:
-        # Fetch all documents from the SURVEY_COLLECTION
-        survey_ref = db.collection(SURVEY_COLLECTION).stream()
-        survey_data = []
-        
-        # Loop through each document in the collection
-        for survey in survey_ref:
-            survey_dict = survey.to_dict()
-            
-            # Extract necessary information
-            userdocumentId = survey_dict.get('userDocumentId')
-            candidateId = survey_dict.get('candidateId')
-            created_at = survey_dict.get('created_at')  # This is likely a Timestamp object
-            precintList = survey_dict.get('precintList')
-            
-            # Print the created_at for debugging
-            print(f"Raw created_at: {created_at}, Type: {type(created_at)}")  # Log the raw value and type
-            
-            # Convert Firestore Timestamp to datetime object
-            if isinstance(created_at, DocumentSnapshot):
-                created_at_date = created_at.to_datetime()  # Use the Firestore Timestamp method
-                print(f"Converted created_at (from DocumentSnapshot): {created_at_date}")  # Log converted value
-            elif isinstance(created_at, datetime):
-                created_at_date = created_at  # If it's already a datetime
-                print(f"created_at is already a datetime: {created_at_date}")  # Log if it's already a datetime
-            else:
-                created_at_date = datetime.fromisoformat(created_at[:-1]) if isinstance(created_at, str) else None
-                print(f"created_at after fallback: {created_at_date}")  # Log fallback value
-
-            if created_at_date is None:
-                logging.error(f"created_at could not be converted for userDocumentId: {userdocumentId}")
-                continue  # Skip this entry if created_at is invalid
-            
-            # Append data including voting information
-            survey_data.append({
-                "userdocumentId": userdocumentId,
-                "candidateId": candidateId,
-                "created_at": created_at_date,
-                "precintList": precintList
-            })
-
-        # Group votes by week and candidate
-        weekly_votes = defaultdict(lambda: defaultdict(lambda: {'count': 0, 'username': None, 'precintList': None}))
-        # {week: {candidateId: {'count': vote_count, 'username': username, 'precintList': precintList}}}
-        
-        for entry in survey_data:
-            # Determine the start of the week (Monday)
-            week_start = entry["created_at"] - timedelta(days=entry["created_at"].weekday())
-            week_str = week_start.strftime("%Y-W%W")  # ISO format for week
-            week_display = f"Week {week_start.isocalendar()[1]} of {week_start.year}"  # More readable format
-
-            # Count the vote for the candidate
-            candidate_id = entry["candidateId"]
-            weekly_votes[week_display][candidate_id]['count'] += 1
-            
-            # Fetch candidate username
-            candidate_ref = db.collection(USERS_COLLECTION).document(candidate_id).get()
-            candidate_username = candidate_ref.to_dict().get("username", "Unknown") if candidate_ref.exists else "Unknown"
-            weekly_votes[week_display][candidate_id]['username'] = candidate_username
-            
-            # Store the precintList
-            if weekly_votes[week_display][candidate_id]['precintList'] is None:
-                weekly_votes[week_display][candidate_id]['precintList'] = entry["precintList"]
-            else:
-                # If there are multiple precincts, you could choose to store them as a list or a string.
-                # Here, we'll keep it simple by ensuring it's the same if not already set.
-                weekly_votes[week_display][candidate_id]['precintList'] = entry["precintList"]
+        # Weekly vote counts come from the survey tallies instead of a Survey scan
+        summary = get_survey_tallies()
+        weekly_votes = summary.get("weeks", {})
+        week_precincts = summary.get("week_precincts", {})
+        # Fetch all candidate names at once
+        candidates = user_profiles.get_many({candidate for votes in weekly_votes.values() for candidate in votes})
 
         # Prepare the final response
         final_response = []
-        for week, candidates in weekly_votes.items():
-            for candidateId, data in candidates.items():
+        for week_str, votes in sorted(weekly_votes.items()):
+            week_start = datetime.fromisoformat(week_str)
+            week = f"Week {week_start.isocalendar()[1]} of {week_start.year}"  # More readable format
+            for candidateId, count in votes.items():
                 final_response.append({
                     "Week": week,
                     "CandidateId": candidateId,
-                    "CandidateUsername": data['username'],
-                    "VoteCount": data['count'],
-                    "PrecintList": data['precintList']  # Include the precintList
+                    "CandidateUsername": get_username(candidateId, candidates),
+                    "VoteCount": count,
+                    "PrecintList": week_precincts.get(week_str, {}).get(candidateId)  # Precinct of the latest survey
                 })
 
         # Return the transformed data
         return JSONResponse(content=final_response)
 
+    except SurveyTalliesNotBuilt:
+        return tallies_not_built_response()
     except Exception as e:
         logging.error(f"Error retrieving weekly report: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving weekly report")
@@ -1206,80 +2594,37 @@ def getWeeklyReportprecint():
 
 
 @app.get('/leader_graph_details/')
-def leader_graph_details():
+@report_cache.cached(*REPORT_TAGS)
+def leader_graph_details(request: Request):
     try:
-        # Fetch all documents from the SURVEY_COLLECTION
-        survey_ref = db.collection(SURVEY_COLLECTION).stream()
-        survey_data = []
-        
-        # Loop through each document in the collection
-        for survey in survey_ref:
-            survey_dict = survey.to_dict()
-            
-            # Extract necessary information
-            userdocumentId = survey_dict.get('userDocumentId')
-            userage = survey_dict.get('age')
-            user_gender = survey_dict.get('gender')
-            candidateId = survey_dict.get('candidateId')
-            electionId = survey_dict.get('electionId')
-            precintList = survey_dict.get('precintList')
-            
-            # Fetch voter data
-            voter_ref = db.collection(VOTERS_COLLECTION).document(precintList).collection('voters').document(userdocumentId)
-            voter_snapshot = voter_ref.get()
-            
-            if voter_snapshot.exists:
-                voter_data = voter_snapshot.to_dict()
-                
-                # Append data including voting information
-                survey_data.append({
-                    "userdocumentId": userdocumentId,
-                    "candidateId": candidateId,
-                    "electionId": electionId,
-                    "voterData": voter_data,
-                    "userage": userage,
-                    "user_gender": user_gender  # Include user gender
-                })
-
-        # Transform data for Power BI
-        transformed_data = {}
-        
-        for entry in survey_data:
-            # Fetch candidate username
-            candidate_ref = db.collection(USERS_COLLECTION).document(entry["candidateId"]).get()
-            candidate_username = candidate_ref.to_dict().get("username", "Unknown") if candidate_ref.exists else "Unknown"
-
-            # Use candidateId, electionId, Province, City, and precintList to create a unique key
-            key = (entry["candidateId"], entry["electionId"], entry["voterData"]["Province"], entry["voterData"]["City"], precintList)
-            if key not in transformed_data:
-                transformed_data[key] = {
-                    "vote_count": 0,
-                    "candidate_username": candidate_username,
-                    "userages": [],  # Store user ages for this key
-                    "user_genders": []  # Store user genders for this key
-                }
-            transformed_data[key]["vote_count"] += 1  # Count votes
-            transformed_data[key]["userages"].append(entry["userage"])  # Collect user ages
-            transformed_data[key]["user_genders"].append(entry["user_gender"])  # Collect user genders
+        # Votes, ages and genders per candidate, election, province, city and
+        # precinct come from the survey tallies instead of a Survey scan
+        tallies = get_graph_tallies()
+        # Fetch all candidate names at once
+        candidates = user_profiles.get_many(tally["candidateId"] for tally in tallies)
 
         # Prepare the final response
         final_response = []
-        for (candidateId, electionId, province, city, precintList), data in transformed_data.items():
+        for tally in tallies:
             final_response.append({
-                "candidateId": candidateId,
-                "electionId": electionId,
-                "Province": province,
-                "City": city,
-                "VoteCount": data["vote_count"],
-                "CandidateUsername": data["candidate_username"],
-                "PrecintList": precintList,
-                "UserAges": data["userages"],  # Include user ages
-                "UserGenders": data["user_genders"]  # Include user genders
+                "candidateId": tally["candidateId"],
+                "electionId": tally["electionId"],
+                "Province": tally["Province"],
+                "City": tally["City"],
+                "VoteCount": tally["votes"],
+                "CandidateUsername": get_username(tally["candidateId"], candidates),
+                "PrecintList": tally["precintList"],
+                "UserAges": tally_values(tally.get("ages", {})),  # Include user ages
+                "UserGenders": tally_values(tally.get("genders", {}))  # Include user genders
             })
 
+        round_trips = request_firestore_calls()
+        logging.info(f"leader_graph_details: {len(tallies)} tallies, {round_trips} Firestore round trips")
         # Return the transformed data
-        return JSONResponse(content=final_response)
+        return JSONResponse(content=final_response, headers={"X-Firestore-Round-Trips": str(round_trips)})
 
+    except SurveyTalliesNotBuilt:
+        return tallies_not_built_response()
     except Exception as e:
         logging.error(f"Error retrieving surveyor details: {e}")
         raise HTTPException(status_code=500, detail="Error retrieving surveyor details")
@@ -0,0 +1,320 @@
+import bisect
+import contextvars
+import inspect
+import logging
+import threading
+import time
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from starlette.responses import StreamingResponse
+
+# Request and Firestore metrics, served by GET /metrics in the Prometheus text
+# format. MetricsRoute (the route class of the app) times every request and
+# measures its response. The Firestore clients are wrapped at the RPC layer
+# by instrument_firestore, which counts the documents read and written and
+# the queries run into the FirestoreUsage of the current request, so a
+# route's Firestore cost per request shows up next to its latency.
+
+# Routes of Firestore calls made outside a request: snapshot listeners,
+# ingestion jobs, background cache refreshes
+BACKGROUND_ROUTE = "(background)"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+CALL_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    # A counter, gauge or histogram with the given label names. Values are
+    # kept per label value tuple; a histogram keeps its bucket counts
+    # (not cumulative), sum and count.
+    def __init__(self, registry, name, help, kind, labels, buckets=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+        registry.metrics.append(self)
+
+    def inc(self, labels, amount=1):
+        with self.registry.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels, amount=1):
+        self.inc(labels, -amount)
+
+    def observe(self, labels, value):
+        with self.registry.lock:
+            histogram = self.values.get(labels)
+            if histogram is None:
+                histogram = self.values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def label_text(self, labels, extra=()):
+        pairs = list(zip(self.labels, labels)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in sorted(self.values.items()):
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{self.label_text(labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{self.label_text(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{self.label_text(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{self.label_text(labels)} {total}")
+            lines.append(f"{self.name}_count{self.label_text(labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labels=()):
+        return Metric(self, name, help, "counter", labels)
+
+    def gauge(self, name, help, labels=()):
+        return Metric(self, name, help, "gauge", labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return Metric(self, name, help, "histogram", labels, buckets)
+
+    def expose(self):
+        with self.lock:
+            lines = [line for metric in self.metrics for line in metric.expose()]
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+http_requests = registry.counter("http_requests_total", "Requests handled, by route, method and status", ("route", "method", "status"))
+http_errors = registry.counter("http_request_errors_total", "Requests that failed with a 5xx status or an exception", ("route", "method"))
+http_in_flight = registry.gauge("http_requests_in_flight", "Requests being handled", ("route", "method"))
+http_latency = registry.histogram("http_request_duration_seconds", "Time to handle a request, including streaming the response", ("route", "method"))
+http_response_size = registry.histogram("http_response_size_bytes", "Response body size before compression", ("route", "method"), SIZE_BUCKETS)
+firestore_reads = registry.counter("firestore_document_reads_total", "Firestore documents read (looked up or returned by a query)", ("route",))
+firestore_writes = registry.counter("firestore_document_writes_total", "Firestore document writes committed", ("route",))
+firestore_queries = registry.counter("firestore_queries_total", "Firestore queries and document listings run", ("route",))
+firestore_calls = registry.counter("firestore_calls_total", "Firestore RPCs (round trips)", ("route",))
+firestore_calls_per_request = registry.histogram("firestore_calls_per_request", "Firestore RPCs made by one request", ("route",), CALL_BUCKETS)
+firestore_reads_per_request = registry.histogram("firestore_document_reads_per_request", "Firestore documents read by one request", ("route",), CALL_BUCKETS)
+
+
+class FirestoreUsage:
+    # Firestore work of one request, added to from any thread
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.queries = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def add(self, reads=0, writes=0, queries=0, calls=0):
+        with self.lock:
+            self.reads += reads
+            self.writes += writes
+            self.queries += queries
+            self.calls += calls
+
+    def record(self, route):
+        labels = (route,)
+        firestore_reads.inc(labels, self.reads)
+        firestore_writes.inc(labels, self.writes)
+        firestore_queries.inc(labels, self.queries)
+        firestore_calls.inc(labels, self.calls)
+
+
+# The FirestoreUsage of the request being handled, if any
+firestore_usage = contextvars.ContextVar("firestore_usage", default=None)
+
+
+def count_firestore(**counts):
+    usage = firestore_usage.get()
+    if usage is not None:
+        usage.add(**counts)
+        return
+    # Outside a request
+    labels = (BACKGROUND_ROUTE,)
+    for kind, metric in (("reads", firestore_reads), ("writes", firestore_writes), ("queries", firestore_queries), ("calls", firestore_calls)):
+        if counts.get(kind):
+            metric.inc(labels, counts[kind])
+
+
+def request_firestore_calls():
+    # Firestore RPCs made so far by the request being handled
+    usage = firestore_usage.get()
+    return usage.calls if usage is not None else 0
+
+
+def in_request_context(function):
+    # function for an executor thread, run in the context of the calling
+    # request, so its Firestore calls count for the request's route
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(function, *args, **kwargs)
+
+
+def request_field(kwargs, field):
+    request = kwargs.get("request")
+    if request is None:
+        return None
+    return request.get(field) if isinstance(request, dict) else getattr(request, field, None)
+
+
+def counted_results(results, has_document):
+    # The results of a streaming RPC, counting a read for every result that
+    # carries a document as it is consumed
+    if hasattr(results, "__aiter__"):
+        async def counted():
+            async for result in results:
+                if has_document(result):
+                    count_firestore(reads=1)
+                yield result
+        return counted()
+
+    def counted():
+        for result in results:
+            if has_document(result):
+                count_firestore(reads=1)
+            yield result
+    return counted()
+
+
+def query_has_document(response):
+    return "document" in response
+
+
+class FirestoreApiMetrics:
+    # Stands in for the generated Firestore API client (sync or async) under
+    # a google.cloud.firestore client, and counts the RPCs made through it
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        method = getattr(self._api, name)
+        if name.startswith("_") or not callable(method):
+            return method
+
+        def counted_method(*args, **kwargs):
+            result = method(*args, **kwargs)
+            if inspect.isawaitable(result):
+                async def counted_call():
+                    return self.count(name, kwargs, await result)
+                return counted_call()
+            return self.count(name, kwargs, result)
+        return counted_method
+
+    def count(self, name, kwargs, result):
+        try:
+            if name in ("commit", "batch_write"):
+                count_firestore(calls=1, writes=len(request_field(kwargs, "writes") or ()))
+            elif name == "batch_get_documents":
+                count_firestore(calls=1, reads=len(request_field(kwargs, "documents") or ()))
+            elif name == "run_query":
+                count_firestore(calls=1, queries=1)
+                return counted_results(result, query_has_document)
+            elif name == "list_documents":
+                count_firestore(calls=1, queries=1)
+                return counted_results(result, lambda document: True)
+            elif name == "run_aggregation_query":
+                # Billed as one read per batch of up to 1000 index entries
+                count_firestore(calls=1, queries=1, reads=1)
+            else:
+                count_firestore(calls=1)
+        except Exception as e:
+            # Never fail a Firestore call over its metrics
+            logging.error(f"Error counting Firestore call {name}: {e}")
+        return result
+
+
+def instrument_firestore(client):
+    # Routes the RPCs of a google.cloud.firestore Client or AsyncClient
+    # through FirestoreApiMetrics. Snapshot listeners use their own channel
+    # and are not counted. This replaces the client's private
+    # _firestore_api_internal, which is why google-cloud-firestore is pinned
+    # in requirements.txt; a release without it fails here rather than
+    # going uncounted.
+    if not hasattr(client, "_firestore_api_internal"):
+        raise RuntimeError(f"Cannot count Firestore calls: {type(client).__name__} has no _firestore_api_internal, check the google-cloud-firestore version")
+    api = FirestoreApiMetrics(client._firestore_api)
+    client._firestore_api_internal = api
+    if client._firestore_api is not api:
+        raise RuntimeError(f"Cannot count Firestore calls: {type(client).__name__}._firestore_api does not use _firestore_api_internal, check the google-cloud-firestore version")
+    return client
+
+
+def record_request(route, method, status, started, usage, size):
+    try:
+        labels = (route, method)
+        http_in_flight.dec(labels)
+        http_requests.inc((route, method, str(status)))
+        if status >= 500:
+            http_errors.inc(labels)
+        http_latency.observe(labels, time.perf_counter() - started)
+        if size is not None:
+            http_response_size.observe(labels, size)
+        usage.record(route)
+        firestore_calls_per_request.observe((route,), usage.calls)
+        firestore_reads_per_request.observe((route,), usage.reads)
+    except Exception as e:
+        logging.error(f"Error recording request metrics: {e}")
+
+
+async def measured_body(body, done):
+    # A streaming response body, calling done with its size once sent
+    size = 0
+    try:
+        async for chunk in body:
+            size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+            yield chunk
+    finally:
+        done(size)
+
+
+class MetricsRoute(APIRoute):
+    # APIRoute recording the metrics of every request it handles, labelled
+    # with its path template. A streaming response is measured when its last
+    # chunk has been sent.
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def measured_handler(request):
+            method = request.method
+            http_in_flight.inc((route, method))
+            usage = FirestoreUsage()
+            # Stays set for the rest of the request task, streaming included
+            firestore_usage.set(usage)
+            started = time.perf_counter()
+            try:
+                response = await handler(request)
+            except Exception as e:
+                status = e.status_code if isinstance(e, HTTPException) else 422 if isinstance(e, RequestValidationError) else 500
+                record_request(route, method, status, started, usage, None)
+                raise
+
+            if isinstance(response, StreamingResponse):
+                status = response.status_code
+                response.body_iterator = measured_body(
+                    response.body_iterator, lambda size: record_request(route, method, status, started, usage, size))
+            else:
+                record_request(route, method, response.status_code, started, usage, len(getattr(response, "body", b"")))
+            return response
+
+        return measured_handler
@@ -0,0 +1,153 @@
+import importlib.util
+import json
+from datetime import date, datetime
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Plain json works too, only slower
+    orjson = None
+
+# Response encoding for the whole app. JSON is written by orjson when it is
+# installed (several times faster than json on the voter lists and reports),
+# with datetimes, including Firestore timestamps, as ISO 8601 strings.
+# CompressionMiddleware compresses larger responses with brotli when the
+# client accepts it and the Brotli package is installed, otherwise with gzip.
+
+# Media types sent as they are: compressed already, or streamed as events
+UNCOMPRESSED_MEDIA_TYPES = (
+    "application/gzip", "application/x-gzip", "application/zip", "application/grpc",
+    "text/event-stream", "font/woff", "image/", "audio/", "video/",
+)
+
+
+def json_default(value):
+    # Types neither encoder knows. orjson encodes datetime itself but not
+    # its subclasses, such as the DatetimeWithNanoseconds Firestore returns.
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    # content as compact UTF-8 JSON bytes
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=json_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    # Drop-in JSONResponse that renders with dumps
+    def render(self, content):
+        return dumps(content)
+
+
+def accepted_encodings(accept_encoding):
+    # Codings of an Accept-Encoding header, without those refused with q=0
+    encodings = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = params.strip().replace(" ", "")
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                pass
+        encodings.add(coding.strip().lower())
+    return encodings
+
+
+class BrotliResponder:
+    # Sends one response of app brotli compressed: a whole body of at least
+    # minimum_size bytes, or a streamed one chunk by chunk. Responses with a
+    # Content-Encoding already, partial content and UNCOMPRESSED_MEDIA_TYPES
+    # go out as they are. The start message is held back until the first
+    # body message decides on the headers.
+    def __init__(self, app, minimum_size, quality):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.quality = quality
+        self.start = None
+        self.compressor = None
+
+    async def __call__(self, scope, receive, send):
+        async def send_compressed(message):
+            await self.send_message(message, send)
+
+        await self.app(scope, receive, send_compressed)
+
+    def compress(self, body, more_body):
+        if more_body:
+            return self.compressor.process(body) + self.compressor.flush()
+        return self.compressor.process(body) + self.compressor.finish()
+
+    async def send_message(self, message, send):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+            if "content-encoding" in headers or message["status"] == 206 or media_type.startswith(UNCOMPRESSED_MEDIA_TYPES):
+                await send(message)
+            else:
+                self.start = message
+            return
+        if message["type"] != "http.response.body":
+            # Trailers, early hints, or a file sent by the server (pathsend)
+            if self.start is not None:
+                start, self.start = self.start, None
+                await send(start)
+            await send(message)
+            return
+        if self.compressor is not None:
+            message["body"] = self.compress(message.get("body", b""), message.get("more_body", False))
+            await send(message)
+            return
+        if self.start is None:
+            await send(message)
+            return
+
+        start, self.start = self.start, None
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if len(body) < self.minimum_size and not more_body:
+            await send(start)
+            await send(message)
+            return
+
+        import brotli
+
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=self.quality)
+        message["body"] = self.compress(body, more_body)
+        headers = MutableHeaders(raw=start["headers"])
+        headers.add_vary_header("Accept-Encoding")
+        headers["Content-Encoding"] = "br"
+        if more_body or start.get("trailers", False):
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(len(message["body"]))
+        await send(start)
+        await send(message)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    # GZipMiddleware plus brotli, which the client gets when its
+    # Accept-Encoding lists br. Responses under minimum_size bytes are sent
+    # as they are. Dynamic responses are compressed once per request, so
+    # speed matters more than ratio: brotli quality 5 and gzip level 6 take
+    # a fraction of the CPU time of the maximum levels, and brotli 5 still
+    # beats gzip on size (see benchmarks/serialization_bench.py).
+    def __init__(self, app, minimum_size=1024, compresslevel=6, brotli_quality=5):
+        super().__init__(app, minimum_size=minimum_size, compresslevel=compresslevel)
+        self.brotli_quality = brotli_quality
+        # Imported by the first response that uses it
+        self.brotli = importlib.util.find_spec("brotli") is not None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and self.brotli and "br" in accepted_encodings(Headers(scope=scope).get("Accept-Encoding", "")):
+            responder = BrotliResponder(self.app, self.minimum_size, self.brotli_quality)
+            await responder(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
@@ -0,0 +1,100 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+# Sessions and passwords for /signin. A session token is a JSON claim set and
+# its HMAC-SHA256 signature, both base64url encoded and joined by a dot, so
+# any instance holding the secret verifies it in microseconds without a
+# Firestore read. Access tokens are short lived; a refresh token gets a new
+# pair from /token/refresh. Passwords are stored as salted PBKDF2 hashes
+# (werkzeug, imported on first use like in the upload routes).
+
+PASSWORD_HASH_PREFIXES = ("pbkdf2:", "scrypt:")
+
+
+class SessionError(Exception):
+    pass
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SessionSigner:
+    # Signs with the first of secrets and accepts any of them, so a secret
+    # can be rotated without logging everybody out
+    def __init__(self, secrets, access_ttl, refresh_ttl):
+        self.keys = [secret.encode() for secret in secrets]
+        self.ttls = {"access": access_ttl, "refresh": refresh_ttl}
+
+    def sign(self, payload, key=None):
+        return hmac.new(key or self.keys[0], payload.encode(), hashlib.sha256).digest()
+
+    def issue(self, kind, user_id, **claims):
+        now = int(time.time())
+        payload = b64encode(json.dumps({"sub": user_id, "typ": kind, "iat": now, "exp": now + int(self.ttls[kind]), **claims}, separators=(",", ":")).encode())
+        return f"{payload}.{b64encode(self.sign(payload))}"
+
+    def issue_pair(self, user_id, claims, password_hash):
+        # The refresh token carries a fingerprint of the password hash, so a
+        # password change ends the sessions started with the old one
+        return {
+            "accessToken": self.issue("access", user_id, **claims),
+            "refreshToken": self.issue("refresh", user_id, pwd=self.fingerprint(password_hash)),
+            "tokenType": "bearer",
+            "expiresIn": int(self.ttls["access"]),
+        }
+
+    def fingerprint(self, password_hash):
+        return b64encode(self.sign(password_hash or "")[:12])
+
+    def verify(self, token, kind):
+        # The claims of a valid, unexpired token of this kind, else SessionError
+        payload, _, signature = token.partition(".")
+        try:
+            signature = b64decode(signature)
+        except ValueError:
+            raise SessionError("Malformed token")
+        if not any(hmac.compare_digest(signature, self.sign(payload, key)) for key in self.keys):
+            raise SessionError("Invalid token signature")
+        try:
+            claims = json.loads(b64decode(payload))
+        except ValueError:
+            raise SessionError("Malformed token")
+        if claims.get("typ") != kind:
+            raise SessionError(f"Not an {kind} token" if kind == "access" else f"Not a {kind} token")
+        if claims.get("exp", 0) < time.time():
+            raise SessionError("Token expired")
+        return claims
+
+
+def password_method(iterations):
+    return f"pbkdf2:sha256:{iterations}"
+
+
+def hash_password(password, iterations):
+    from werkzeug.security import generate_password_hash
+
+    return generate_password_hash(password, method=password_method(iterations))
+
+
+def check_password(stored, password):
+    # Accounts created before passwords were hashed store them in plain text
+    if not stored:
+        return False
+    if not stored.startswith(PASSWORD_HASH_PREFIXES):
+        return hmac.compare_digest(stored.encode(), password.encode())
+    from werkzeug.security import check_password_hash
+
+    return check_password_hash(stored, password)
+
+
+def needs_rehash(stored, iterations):
+    # Plain text, or hashed with another method or cost than the current one
+    return stored.partition("$")[0] != password_method(iterations)
@@ -0,0 +1,599 @@
+import gzip
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# Regular expressions to extract precinct, city, province, and barangay
+prec_regex = re.compile(r'Prec\s*:\s*(\d+\w?)')
+city_regex = re.compile(r'CITY / MUNICIPALITY : (.+)')
+province_regex = re.compile(r'PROVINCE : (.+)')
+barangay_line_regex = re.compile(r'BARANGAY : (.+)')
+
+# Regex to extract names with an asterisk followed by a space
+asterisk_name_regex = re.compile(r'\*\s+([A-Z]+(?:\s[A-Z]+)*)\s+([A-Z]+(?:\s[A-Z]+)*)\s+([A-Z]+(?:\s[A-Z]+)*)\s+(PRK\.?\s+.+)', re.IGNORECASE)
+# Regex to capture general voter information with or without prefix, including commas
+voter_info_regex = re.compile(r'(\d+)?\s*[*]?\s*([A-Z]+(?:\s[A-Z]+)*),?\s+([A-Z]+(?:\s[A-Z]+)*)\s+([A-Z]+(?:\s[A-Z]+)*)\s+(PRK\.?\s+.+)', re.IGNORECASE)
+# Regex to capture lines starting with a number
+number_start_regex = re.compile(r'^\d+\s+')
+
+# Case-sensitive equivalents used by the fast classifier. Under IGNORECASE,
+# [A-Z] also matches a-z and the four Unicode letters below (and K also
+# matches KELVIN SIGN), so these match exactly the same strings while
+# skipping the per-character case folding.
+NAME_WORD = r'[A-Za-z\u0130\u0131\u017f\u212a]+'
+NAME = rf'{NAME_WORD}(?:\s{NAME_WORD})*'
+PRK = r'[Pp][Rr][Kk\u212a]'
+# Every voter and asterisk line carries a PRK address
+prk_regex = re.compile(PRK)
+fast_asterisk_name_regex = re.compile(rf'\*\s+({NAME})\s+({NAME})\s+({NAME})\s+({PRK}\.?\s+.+)')
+fast_voter_info_regex = re.compile(rf'(\d+)?\s*[*]?\s*({NAME}),?\s+({NAME})\s+({NAME})\s+({PRK}\.?\s+.+)')
+
+final_add = {
+    'PRK.',
+    'CENTRO',
+    'PUROK',
+    'RK',
+    'RK.',
+    'PRK.1',
+    'PRPK.'
+}
+
+# Number of worker processes used by the parallel parser (0 = one per CPU)
+PDF_PARSE_WORKERS = int(os.environ.get("PDF_PARSE_WORKERS", "0"))
+# "fast" classifies each line once, "reference" runs the full regex chain
+PARSER_MODE = os.environ.get("VOTER_PARSER_MODE", "fast")
+# Below this many pages per worker the process pool costs more than it saves
+MIN_PAGES_PER_WORKER = 8
+
+VOTER_FIELDS = ["Voter No", "Full Name", "Address", "Barangay", "City", "Province"]
+# The last three voter fields, shared by every voter of a precinct
+LOCATION_FIELDS = VOTER_FIELDS[3:]
+
+# Parsed voter lists are cached on disk by the SHA-256 of the PDF, least
+# recently used entries are evicted once the cache grows past the size limit
+PARSE_CACHE_DIR = os.environ.get("PARSE_CACHE_DIR", os.path.join("uploads", "parse_cache"))
+PARSE_CACHE_MAX_BYTES = int(os.environ.get("PARSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+PARSE_CACHE_VERSION = 2
+
+# Events emitted by VoterListParser.feed_line
+PRECINCT_EVENT = "precinct"    # a "Prec :" header was seen
+VOTER_EVENT = "voter"          # voter row for an already opened precinct
+ASTERISK_EVENT = "asterisk"    # asterisk voter row, opens the precinct if needed
+
+
+def convert_line_to_list(line):
+    # Define the pattern to split the line based on commas
+    parts = [part.strip() for part in line.split(',')]
+    return parts
+
+
+def seprate_number_name(numberName):
+    onlyNumber = re.findall(r'\b\d+\b', numberName)
+    return onlyNumber
+
+
+def remove_number(number_name, only_numbers):
+    # Remove all found numbers from the input string
+    for num in only_numbers:
+        number_name = number_name.replace(num, "").strip()
+    return number_name
+
+
+def extract_only_number_firstName(data):
+    onlyNumber = seprate_number_name(data)
+    final = remove_number(data, onlyNumber)
+    firstName = ""
+    remove_special = final.split(" ")
+    if len(remove_special) > 1:
+        firstName = remove_special[1]
+    else:
+        firstName = remove_special[0]
+    return onlyNumber, firstName
+
+
+def split_address(address):
+    parts = [part.strip() for part in address.split(',')]
+    final_parts = []
+    for part in parts:
+        sub_parts = [sub_part for sub_part in part.split() if sub_part]
+        final_parts.extend(sub_parts)
+    return final_parts
+
+
+def split_array(arr, final_add):
+    final_add_set = set(final_add)
+    split_index = None
+    for i, item in enumerate(arr):
+        if item in final_add_set:
+            split_index = i
+            break
+    if split_index is None:
+        return [arr, []]
+    first_part = arr[:split_index]
+    second_part = arr[split_index:]
+    return [first_part, second_part]
+
+
+def get_non_matching(result):
+    # Initialize variables
+    final_address = []
+    main_data = []
+
+    # Convert the result to a formatted list
+    formatted_list = convert_line_to_list(result)
+
+    # Extract relevant data
+    precint_no = formatted_list[0]
+    onlyNumber, firstName = extract_only_number_firstName(formatted_list[1])
+
+    # Split the address
+    get_address = split_address(formatted_list[2])
+
+    # Determine how to handle the address
+    if len(get_address) == 1:
+        final_address = formatted_list[2] + " " + formatted_list[3]
+        final_address = final_address.split(" ")
+    else:
+        final_address = get_address
+
+    # Separate address parts
+    seprating_address = split_array(final_address, final_add)
+
+    # Extract middle name/last name and address info
+    middle_name_last_name = seprating_address[0]
+    address_info = seprating_address[1]
+
+    # Concatenate first name with middle name/last name
+    fullname = " ".join([firstName] + middle_name_last_name)
+    address_data = " ".join(address_info)
+
+    return onlyNumber[0], fullname, address_data
+
+
+# A classified line is a tuple of
+#   (precinct, city, province, barangay, voter, numbered, asterisk)
+# with the header values (None when absent), the (voter no, full name,
+# address) of a voter line, whether the line is a numbered line for the
+# get_non_matching fallback, and the (full name, address) of an asterisk line
+
+
+def voter_fields(voter_match):
+    voter_no, last_name, first_name, middle_name, address = voter_match.groups()
+    return (voter_no if voter_no else "", f"{last_name} {first_name} {middle_name}".strip(), address)
+
+
+def asterisk_fields(asterisk_match):
+    last_name, first_name, middle_name, address = asterisk_match.groups()
+    return (f"{last_name} {first_name} {middle_name}".strip(), address)
+
+
+def classify_line_reference(line):
+    # Reference mode: every regex of the original chain is tried on every line
+    prec_match = prec_regex.search(line)
+    city_match = city_regex.search(line)
+    province_match = province_regex.search(line)
+    barangay_match = barangay_line_regex.search(line)
+    voter_match = voter_info_regex.match(line)
+    numbered = voter_match is None and number_start_regex.match(line) is not None
+    asterisk_match = asterisk_name_regex.match(line)
+    return (
+        prec_match.group(1) if prec_match else None,
+        city_match.group(1) if city_match else None,
+        province_match.group(1) if province_match else None,
+        barangay_match.group(1) if barangay_match else None,
+        voter_fields(voter_match) if voter_match else None,
+        numbered,
+        asterisk_fields(asterisk_match) if asterisk_match else None,
+    )
+
+
+def classify_line(line):
+    # Decide up front which of the patterns can possibly match and only run
+    # those. The header patterns can overlap on one line (a greedy
+    # "PROVINCE : (.+)" swallows a following "CITY / MUNICIPALITY : ..."), so
+    # each header keeps its own regex, but only behind a substring check.
+    precinct = city = province = barangay = None
+    if ':' in line:
+        if 'Prec' in line:
+            match = prec_regex.search(line)
+            precinct = match.group(1) if match else None
+        # A header can come with an empty value, which its regex rejects
+        if 'CITY / MUNICIPALITY : ' in line:
+            match = city_regex.search(line)
+            city = match.group(1) if match else None
+        if 'PROVINCE : ' in line:
+            match = province_regex.search(line)
+            province = match.group(1) if match else None
+        if 'BARANGAY : ' in line:
+            match = barangay_line_regex.search(line)
+            barangay = match.group(1) if match else None
+
+    # Voter and asterisk lines both end with a PRK address
+    voter = asterisk = None
+    if prk_regex.search(line):
+        match = fast_voter_info_regex.match(line)
+        if match:
+            voter = voter_fields(match)
+        if line[:1] == '*':
+            match = fast_asterisk_name_regex.match(line)
+            if match:
+                asterisk = asterisk_fields(match)
+
+    numbered = voter is None and line[:1].isdigit() and number_start_regex.match(line) is not None
+    return (precinct, city, province, barangay, voter, numbered, asterisk)
+
+
+LINE_CLASSIFIERS = {
+    "fast": classify_line,
+    "reference": classify_line_reference,
+}
+
+
+class Voter:
+    # One parsed voter. location is the (barangay, city, province) tuple, one
+    # shared object for all the voters of a location instead of three string
+    # fields per voter
+    __slots__ = ("number", "name", "address", "location")
+
+    def __init__(self, number, name, address, location):
+        self.number = number
+        self.name = name
+        self.address = address
+        self.location = location
+
+    def __reduce__(self):
+        # Pickled as a plain tuple on the way back from the worker processes
+        return (Voter, (self.number, self.name, self.address, self.location))
+
+    def __eq__(self, other):
+        return isinstance(other, Voter) and self.to_tuple() == other.to_tuple()
+
+    def __repr__(self):
+        return f"Voter{self.to_tuple()!r}"
+
+    def to_tuple(self):
+        return (self.number, self.name, self.address, *self.location)
+
+    def to_dict(self):
+        return dict(zip(VOTER_FIELDS, self.to_tuple()))
+
+
+class VoterListParser:
+    # Line-by-line parser for COMELEC voter lists. The precinct, barangay, city
+    # and province carry over from line to line (and page to page), so one
+    # parser instance has to see the lines in document order.
+
+    def __init__(self, mode=None):
+        self.classify = LINE_CLASSIFIERS[mode or PARSER_MODE]
+        self.city = self.province = self.barangay = ""
+        self.current_precinct = ""
+        # Interned (barangay, city, province) tuples
+        self.locations = {}
+        self.location = self.get_location()
+        # Which header fields were assigned by this parser itself
+        self.seen = set()
+
+    def state_is_known(self):
+        return len(self.seen) == 4
+
+    def get_state(self):
+        return (self.current_precinct, self.barangay, self.city, self.province)
+
+    def set_state(self, state):
+        self.current_precinct, self.barangay, self.city, self.province = state
+        self.location = self.get_location()
+
+    def get_location(self):
+        location = (self.barangay, self.city, self.province)
+        return self.locations.setdefault(location, location)
+
+    def feed_line(self, line):
+        events = []
+        precinct, city, province, barangay, voter, numbered, asterisk = self.classify(line)
+
+        # Check and extract precinct number
+        if precinct is not None:
+            self.current_precinct = precinct
+            self.seen.add("precinct")
+            events.append((PRECINCT_EVENT, precinct, None))
+
+        # Check and extract city, province, and barangay
+        if city is not None:
+            self.city = city
+            self.seen.add("city")
+        if province is not None:
+            self.province = province
+            self.seen.add("province")
+        if barangay is not None:
+            self.barangay = barangay
+            self.seen.add("barangay")
+        if city is not None or province is not None or barangay is not None:
+            self.location = self.get_location()
+
+        current_precinct = self.current_precinct
+        location = self.location
+
+        # Extract voter information and store it under the current precinct
+        if voter:
+            voter_no, full_name, address = voter
+            events.append((VOTER_EVENT, current_precinct, Voter(voter_no, full_name, address, location)))
+        elif numbered:
+            # The line starts with a number but does not match the primary format
+            barangay, city, province = location
+            formatted_result = f"{current_precinct}, {line}, {barangay}, {city}, {province}"
+            onlyNumber, fullname, address_info = get_non_matching(formatted_result)
+            events.append((VOTER_EVENT, current_precinct, Voter(onlyNumber, fullname, address_info, location)))
+
+        # Names with an asterisk followed by a space
+        if asterisk:
+            full_name, address = asterisk
+            events.append((ASTERISK_EVENT, current_precinct, Voter('', full_name, address, location)))
+
+        return events
+
+
+def parse_page_range(pdf_path, start, stop, mode=None):
+    # Worker entry point: parse pages [start, stop) without knowing the
+    # precinct/location state left over from the previous range. Lines are
+    # kept raw until this range has set all four header fields itself; from
+    # then on the state no longer depends on earlier pages and the lines can
+    # be parsed here. The caller replays the raw prefix with the real state.
+    import pdfplumber
+
+    parser = VoterListParser(mode)
+    prefix_lines = []
+    events = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for page in pdf.pages[start:stop]:
+            text = page.extract_text()
+            lines = text.split("\n")
+            for line in lines:
+                if parser.state_is_known():
+                    events.extend(parser.feed_line(line))
+                else:
+                    prefix_lines.append(line)
+                    parser.feed_line(line)
+    state = parser.get_state() if parser.state_is_known() else None
+    return prefix_lines, events, state
+
+
+def iter_events(events, opened):
+    # Turn parser events into (precinct, voter) pairs. voter is None the first
+    # time a precinct is seen, so precincts without any voters still show up.
+    for kind, precinct, voter in events:
+        if kind == PRECINCT_EVENT:
+            if precinct not in opened:
+                opened.add(precinct)
+                yield precinct, None
+        elif kind == VOTER_EVENT:
+            if precinct not in opened:
+                raise KeyError(precinct)
+            yield precinct, voter
+        else:
+            if precinct not in opened:
+                opened.add(precinct)
+                yield precinct, None
+            yield precinct, voter
+
+
+def iter_voters_serial(pdf_path, on_page=None, mode=None):
+    import pdfplumber
+
+    opened = set()
+    parser = VoterListParser(mode)
+
+    # Open the PDF file
+    with pdfplumber.open(pdf_path) as pdf:
+        page_count = len(pdf.pages)
+        for page_no, page in enumerate(pdf.pages, start=1):
+            text = page.extract_text()
+            lines = text.split("\n")
+            events = []
+            for line in lines:
+                events.extend(parser.feed_line(line))
+            yield from iter_events(events, opened)
+            if on_page:
+                on_page(page_no, page_count)
+
+
+def iter_voters_parallel(pdf_path, workers, page_count, on_page=None, mode=None):
+    # Several ranges per worker so a slow range does not hold up the whole pool
+    tasks = min(page_count, workers * 4)
+    step = math.ceil(page_count / tasks)
+    ranges = iter([(start, min(start + step, page_count)) for start in range(0, page_count, step)])
+
+    opened = set()
+    parser = VoterListParser(mode)
+
+    # spawn, not fork: the parent process holds gRPC (Firestore) threads
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    try:
+        # Only keep a couple of ranges per worker in flight so memory stays bounded
+        pending = deque((executor.submit(parse_page_range, pdf_path, start, stop, mode), stop) for start, stop in islice(ranges, workers * 2))
+        # Stitch the ranges back together in page order
+        while pending:
+            future, stop = pending.popleft()
+            prefix_lines, events, state = future.result()
+            next_range = next(ranges, None)
+            if next_range:
+                pending.append((executor.submit(parse_page_range, pdf_path, *next_range, mode), next_range[1]))
+
+            for line in prefix_lines:
+                yield from iter_events(parser.feed_line(line), opened)
+            yield from iter_events(events, opened)
+            if state is not None:
+                parser.set_state(state)
+            if on_page:
+                on_page(stop, page_count)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_voter_information_from_pdf(pdf_path, workers=None, on_page=None, mode=None):
+    # Yields (precinct, Voter) pairs page by page without holding the whole
+    # voter list in memory. voter is None when a precinct is first seen.
+    # on_page(pages_done, page_count) is called as pages are finished.
+    if workers is None:
+        workers = PDF_PARSE_WORKERS or os.cpu_count() or 1
+
+    if workers > 1:
+        import pdfplumber
+
+        with pdfplumber.open(pdf_path) as pdf:
+            page_count = len(pdf.pages)
+        workers = min(workers, page_count // MIN_PAGES_PER_WORKER)
+        if workers > 1:
+            return iter_voters_parallel(pdf_path, workers, page_count, on_page, mode)
+
+    return iter_voters_serial(pdf_path, on_page, mode)
+
+
+def extract_voter_information_from_pdf(pdf_path, workers=None, mode=None):
+    precinct_voters = {}
+    for precinct, voter in iter_voter_information_from_pdf(pdf_path, workers, mode=mode):
+        if voter is None:
+            precinct_voters[precinct] = []
+        else:
+            precinct_voters[precinct].append(voter.to_dict())
+
+    # Process and store the extracted data in the results dictionary
+    results = {}
+    for precinct, voters in precinct_voters.items():
+        results[precinct] = {
+            "precinct": precinct,
+            "total_voters": len(voters),
+            "voters": voters
+        }
+    return results
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    # Content-addressed cache of parser output. Each entry is a gzipped file
+    # of JSON lines, one per parser item, so it can be written and replayed
+    # as a stream:
+    #   ["P", precinct]                             precinct first seen
+    #   ["L", barangay, city, province]             next location, numbered from 0
+    #   ["V", precinct, number, name, address, n]   voter at location n
+    #   ["G", pages_done, page_count]               page progress
+    # Entries only become visible once complete. Reading an entry bumps its
+    # mtime, which is what the LRU eviction goes by.
+
+    def __init__(self, directory=PARSE_CACHE_DIR, max_bytes=PARSE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, sha256):
+        return os.path.join(self.directory, f"{sha256}.v{PARSE_CACHE_VERSION}.jsonl.gz")
+
+    def lookup(self, sha256):
+        path = self.path_for(sha256)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def replay(self, path, on_page=None):
+        locations = []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                item = json.loads(line)
+                kind = item[0]
+                if kind == "V":
+                    yield item[1], Voter(item[2], item[3], item[4], locations[item[5]])
+                elif kind == "P":
+                    yield item[1], None
+                elif kind == "L":
+                    locations.append(tuple(item[1:]))
+                elif on_page:
+                    on_page(item[1], item[2])
+
+    def record(self, sha256, items, on_page=None):
+        # Pass items through while writing them to a temporary entry
+        path = self.path_for(sha256)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        completed = False
+        location_ids = {}
+
+        def write_page(pages_done, page_count):
+            f.write(json.dumps(["G", pages_done, page_count]) + "\n")
+            if on_page:
+                on_page(pages_done, page_count)
+
+        iterator = items(write_page)
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+                for precinct, voter in iterator:
+                    if voter is None:
+                        f.write(json.dumps(["P", precinct], ensure_ascii=False) + "\n")
+                    else:
+                        location_id = location_ids.get(voter.location)
+                        if location_id is None:
+                            location_id = location_ids[voter.location] = len(location_ids)
+                            f.write(json.dumps(["L", *voter.location], ensure_ascii=False) + "\n")
+                        f.write(json.dumps(["V", precinct, voter.number, voter.name, voter.address, location_id], ensure_ascii=False) + "\n")
+                    yield precinct, voter
+            os.replace(tmp_path, path)
+            completed = True
+            self.evict()
+        finally:
+            iterator.close()
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".jsonl.gz"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+parse_cache = ParseCache()
+
+
+def iter_voter_information_cached(pdf_path, sha256=None, workers=None, on_page=None, mode=None):
+    # Same items as iter_voter_information_from_pdf, but a PDF that was parsed
+    # before is replayed from the parse cache without opening it
+    if sha256 is None:
+        sha256 = file_sha256(pdf_path)
+
+    cached_path = parse_cache.lookup(sha256)
+    if cached_path:
+        return parse_cache.replay(cached_path, on_page)
+
+    return parse_cache.record(sha256, lambda record_page: iter_voter_information_from_pdf(pdf_path, workers, record_page, mode), on_page)